@@ -2,12 +2,15 @@
 
 import base64
 import datetime
+import math
 
 from google.appengine.ext import ndb
 
 
 EPOCH = datetime.datetime.utcfromtimestamp(0)
 
+EARTH_RADIUS_MILES = 3958.8
+
 
 def Milis(dt):
   """Converts a datetime to miliseconds since epoch.
@@ -21,6 +24,38 @@ def Milis(dt):
   return int((dt - EPOCH).total_seconds() * 1000)
 
 
+def FromMilis(ms):
+  """Converts miliseconds since epoch to a datetime.
+
+  Args:
+    ms: (int) Miliseconds since epoch.
+
+  Returns:
+    (datetime.datetime) The datetime.
+  """
+  return EPOCH + datetime.timedelta(milliseconds=ms)
+
+
+def Miles(latitude1, longitude1, latitude2, longitude2):
+  """Computes the great-circle distance between two points.
+
+  Args:
+    latitude1: (float) Degrees latitude of the first point.
+    longitude1: (float) Degrees longitude of the first point.
+    latitude2: (float) Degrees latitude of the second point.
+    longitude2: (float) Degrees longitude of the second point.
+
+  Returns:
+    (float) The distance in miles.
+  """
+  phi1, phi2 = math.radians(latitude1), math.radians(latitude2)
+  d_phi = phi2 - phi1
+  d_lambda = math.radians(longitude2 - longitude1)
+  a = (math.sin(d_phi / 2) ** 2 +
+       math.cos(phi1) * math.cos(phi2) * math.sin(d_lambda / 2) ** 2)
+  return 2 * EARTH_RADIUS_MILES * math.asin(min(1.0, math.sqrt(a)))
+
+
 def JsonEncoder(obj):
   """Handles encoding to JSON of objects that python usually wigs out on.
 
@@ -50,6 +50,9 @@ class LoadOutformat(ndb.Model):
   gender_string = ndb.StringProperty()  # If MatchParameters.gender == 2
   sexuality_string = ndb.StringProperty()  # If MatchParameters.sexuality == 3
   joined = ndb.DateTimeProperty()
+  # Change whenever the intro or image does, so clients can cache the files.
+  intro_hash = ndb.StringProperty()
+  image_hash = ndb.StringProperty()
   # 0=male, 1=female, 2=other
   gender = ndb.IntegerProperty(choices=[0, 1, 2])
   # 0=gay, 1=straight, 2=bi, 3=other
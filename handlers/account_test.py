@@ -43,6 +43,15 @@ class AccountHandlerTest(unittest.TestCase):
     out_audio = interface.GetForUid(model.IntroFile, testutils.DEFAULT_UID).blob
     self.assertEqual(audio, out_audio)
 
+  def testLoadAfterSetFiles(self):
+    interface.SetIntro(
+        testutils.DEFAULT_UID, testutils.Resource("intro.aac"))
+    interface.SetImage(testutils.DEFAULT_UID, testutils.Resource("icon.png"))
+    _, args = self.api.Call("/account/load")
+    user = interface.GetUser(testutils.DEFAULT_UID)
+    self.assertEqual(user.intro_hash, args["intro_hash"])
+    self.assertEqual(user.image_hash, args["image_hash"])
+
   def testSetImage(self):
     img = testutils.Resource("icon.png")
     self.api.Call("/account/set_image", blob=common.Encode(img))
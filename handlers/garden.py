@@ -65,7 +65,8 @@ class Send(util.AuthedHandler):
     success = interface.SendRose(
         uid,
         self.GetArg("recipient"),
-        self.GetArg("rose_number"))
+        self.GetArg("rose_number"),
+        idempotency_key=self.GetEnv("idempotency_key"))
     self.SetArg("success", bool(success))
     if success:
       self.SetArg("roses", interface.GetGarden(uid))
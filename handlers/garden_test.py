@@ -37,6 +37,17 @@ class GardenTest(unittest.TestCase):
     _, args = self.api.Call("/garden/send", recipient=2, rose_number=1)
     self.assertFalse(args["success"])
 
+  def testSendIdempotent(self):
+    env = {"idempotency_key": "abc"}
+    _, args = self.api.Call(
+        "/garden/send", env=env, recipient=2, rose_number=2)
+    self.assertTrue(args["success"])
+    roses = args["roses"]
+    _, args = self.api.Call(
+        "/garden/send", env=env, recipient=2, rose_number=2)
+    self.assertTrue(args["success"])
+    self.assertEqual(roses, args["roses"])
+
   def testWaterPayment(self):
     #TODO
     pass
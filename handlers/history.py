@@ -17,23 +17,26 @@ ROUTES = []
 # --------------------------------------------------------------------------- #
 
 class LoadInformat(ndb.Model):
-  offset = ndb.IntegerProperty()
+  offset = ndb.IntegerProperty()  # Deprecated; use cursor
   limit = ndb.IntegerProperty()
+  cursor = ndb.StringProperty()
   cache_time = ndb.DateTimeProperty()
   ascending = ndb.BooleanProperty()
   new = ndb.BooleanProperty()
   saved_only = ndb.BooleanProperty()
   blocked_only = ndb.BooleanProperty()
   sent_rose_only = ndb.BooleanProperty()
-  reeived_rose_only = ndb.BooleanProperty()
+  received_rose_only = ndb.BooleanProperty()
   sent_message_only = ndb.BooleanProperty()
-  received_message_property = ndb.BooleanProperty()
+  received_message_only = ndb.BooleanProperty()
   visited_only = ndb.BooleanProperty()
-  visited_by_ony = ndb.BooleanProperty()
+  visited_by_only = ndb.BooleanProperty()
+  light = ndb.BooleanProperty()  # Uids, sort times, and unread counts only
 
 
 class LoadOutformat(ndb.Model):
-  pass
+  history = ndb.JsonProperty()
+  next_cursor = ndb.StringProperty()  # Absent on the last page
 
 
 class Load(util.AuthedHandler):
@@ -42,8 +45,49 @@ class Load(util.AuthedHandler):
   out_format = LoadOutformat
 
   def Handle(self):
-    util.TODO()
-    history = interface.History(self.GetEnv("uid"), **self.args)
+    history, next_cursor = interface.History(self.GetEnv("uid"), **self.args)
+    self.UpdateArgs(history=history, next_cursor=next_cursor)
 
 
 ROUTES.append(("/history/load/*", Load))
+
+
+# --------------------------------------------------------------------------- #
+# Load the most recent visitors to the user's profile.                        #
+# --------------------------------------------------------------------------- #
+
+class VisitorsOutformat(ndb.Model):
+  visitors = ndb.JsonProperty()  # Most recent first
+
+
+class Visitors(util.AuthedHandler):
+
+  in_format = ioformat.Trivial
+  out_format = VisitorsOutformat
+
+  def Handle(self):
+    self.SetArg("visitors", interface.GetRecentVisitors(self.GetEnv("uid")))
+
+
+ROUTES.append(("/history/visitors/*", Visitors))
+
+
+# --------------------------------------------------------------------------- #
+# Load the user's total unread roses and messages, for the app badge.         #
+# --------------------------------------------------------------------------- #
+
+class BadgeOutformat(ndb.Model):
+  new_roses = ndb.IntegerProperty(required=True)
+  new_messages = ndb.IntegerProperty(required=True)
+
+
+class Badge(util.AuthedHandler):
+
+  in_format = ioformat.Trivial
+  out_format = BadgeOutformat
+
+  def Handle(self):
+    self.UpdateArgs(interface.GetBadge(self.GetEnv("uid")))
+
+
+ROUTES.append(("/history/badge/*", Badge))
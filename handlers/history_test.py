@@ -25,7 +25,29 @@ class HistoryTest(unittest.TestCase):
     cls.api.Stop()
 
   def testLoad(self):
-    _, args = self.api.Call("/history/load")
+    audio = testutils.Resource("intro.aac")
+    now = datetime.datetime.today()
+    for partner in (2, 3, 4, 5):
+      interface.SendMessage(
+          partner, 1, audio, now=now + datetime.timedelta(partner))
+    _, args = self.api.Call("/history/load", limit=3)
+    self.assertEqual([5, 4, 3], [rel["uid"] for rel in args["history"]])
+    _, args = self.api.Call(
+        "/history/load", limit=3, cursor=args["next_cursor"])
+    self.assertEqual([2], [rel["uid"] for rel in args["history"]])
+
+  def testVisitors(self):
+    now = datetime.datetime.today()
+    interface.RecordVisit(3, 1, now=now)
+    interface.RecordVisit(2, 1, now=now + datetime.timedelta(1))
+    _, args = self.api.Call("/history/visitors")
+    self.assertEqual([2, 3], [visit["uid"] for visit in args["visitors"]])
+
+  def testBadge(self):
+    interface.SendRose(4, 2, 1)
+    _, args = self.api.Call("/history/badge", env={"uid": 2})
+    self.assertEqual(1, args["new_roses"])
+    self.assertEqual(0, args["new_messages"])
 
 
 if __name__ == "__main__":
@@ -70,7 +70,38 @@ class Send(util.FileAcceptingAuthedHandler):
     send_time = interface.SendMessage(
         self.GetEnv("uid"),
         self.GetArg("recipient"),
-        self.file)
+        self.file,
+        idempotency_key=self.GetEnv("idempotency_key"))
     self.SetArg("send_timestamp_ms", common.Milis(send_time))
 
 ROUTES.append(("/message/send/*", Send))
+
+
+# --------------------------------------------------------------------------- #
+# List the messages in a conversation.                                        #
+# --------------------------------------------------------------------------- #
+
+class ThreadInformat(ndb.Model):
+  partner = ndb.IntegerProperty(required=True)
+  before_ms = ndb.IntegerProperty()
+  limit = ndb.IntegerProperty()
+
+
+class ThreadOutformat(ndb.Model):
+  messages = ndb.JsonProperty()
+  next_before_ms = ndb.IntegerProperty()  # Absent on the last page
+
+
+class Thread(util.AuthedHandler):
+
+  in_format = ThreadInformat
+  out_format = ThreadOutformat
+
+  def Handle(self):
+    messages, next_before_ms = interface.Thread(
+        self.GetEnv("uid"), self.GetArg("partner"),
+        before_ms=self.GetArg("before_ms"),
+        limit=self.GetArg("limit") or interface.THREAD_PAGE_SIZE)
+    self.UpdateArgs(messages=messages, next_before_ms=next_before_ms)
+
+ROUTES.append(("/message/thread/*", Thread))
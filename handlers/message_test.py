@@ -35,6 +35,17 @@ class InterfaceTest(unittest.TestCase):
     blob_out = args["blob"]
     self.assertEqual(blob_in, blob_out)
 
+  def testIdempotentSend(self):
+    blob = common.Encode(testutils.Resource("intro.aac"))
+    env = {"uid": 2, "idempotency_key": "abc"}
+    _, args = self.api.Call("/message/send", env=env, recipient=3, blob=blob)
+    send_ts = args["send_timestamp_ms"]
+    _, args = self.api.Call("/message/send", env=env, recipient=3, blob=blob)
+    self.assertEqual(send_ts, args["send_timestamp_ms"])
+    _, args = self.api.Call("/message/thread", env={"uid": 2}, partner=3)
+    self.assertEqual(
+        [send_ts], [msg["send_timestamp_ms"] for msg in args["messages"]])
+
   def testVerifyListen(self):
     env, _ = self.api.Call(
         "/message/listen",
@@ -48,6 +59,20 @@ class InterfaceTest(unittest.TestCase):
         ("VerificationError: While checking input: ValueError: "
          "User 3 tried to listen to a message from 1 to 2"))
 
+  def testThread(self):
+    blob = common.Encode(testutils.Resource("intro.aac"))
+    _, args = self.api.Call("/message/send", recipient=3, blob=blob)
+    send_ts = args["send_timestamp_ms"]
+    _, args = self.api.Call("/message/thread", env={"uid": 3}, partner=1)
+    self.assertEqual(
+        [{"send_timestamp_ms": send_ts, "sent": False, "new": True,
+          "retrieval_count": 0}],
+        args["messages"])
+    self.assertEqual(None, args.get("next_before_ms"))
+    _, args = self.api.Call(
+        "/message/thread", env={"uid": 3}, partner=1, limit=None)
+    self.assertEqual(1, len(args["messages"]))
+
 
 if __name__ == "__main__":
   unittest.main()
@@ -0,0 +1,323 @@
+"""Caching layers for frequently read datastore entities and files.
+
+Entities are cached in memcache by key, for a time-to-live configured per kind.
+Lookups of entities that don't exist are remembered too, for a shorter time, so
+repeated requests for bogus ids don't each cost a datastore read. Reads made
+inside a transaction always go straight to the datastore. Anything that writes
+(or creates) a cached kind is responsible for calling Invalidate on the keys it
+changed. Read-throughs skip ndb's own memcache layer, so a miss costs one
+memcache round trip rather than two.
+
+Files too big for memcache, like audio intros and chat images, are instead
+kept in a size-bounded LRU cache local to each instance; see BlobCache.
+
+Query results are cached under a version stamp for the data they depend on,
+which writers bump instead of tracking down every affected result; see
+GetInboxVersion and TouchInbox.
+"""
+
+import collections
+import hashlib
+import threading
+import time
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+
+# Seconds to keep each kind of entity in memcache. Kinds that aren't listed (or
+# have a falsy ttl) aren't cached. Audio and image files can exceed the
+# memcache value size limit, so they're deliberately left out.
+TTLS = {
+    "User": 10 * 60,
+    "MatchParameters": 60,
+    "SearchSettings": 10 * 60,
+    "SentRose": 60 * 60,
+    "ReceivedRose": 60 * 60,
+    "SentMessage": 5 * 60,
+    "ReceivedMessage": 5 * 60,
+    "UnreadTotals": 10 * 60,
+    }
+
+# Seconds to remember that an entity of each kind doesn't exist.
+NEGATIVE_TTLS = {
+    "User": 30,
+    "MatchParameters": 30,
+    "SearchSettings": 30,
+    "IntroFile": 30,
+    "ImageFile": 30,
+    }
+
+# Cached in place of entities that don't exist.
+_MISSING = "missing"
+
+# After an invalidation, refuse to re-cache the entity for this many seconds,
+# so that a reader racing the write can't put the stale version back.
+LOCK_SECONDS = 1
+
+# Per-instance lookup counts, keyed by (kind, "hits", "negative_hits", or
+# "misses").
+STATS = collections.Counter()
+
+# Seconds to keep History results for an unchanged inbox.
+HISTORY_TTL = 10 * 60
+
+# Bytes of file blobs each instance may hold in memory.
+BLOB_CACHE_BYTES = 32 * 1024 * 1024
+
+
+def _CacheKey(key):
+  """Returns the memcache key for a datastore key."""
+  return "entity:" + key.urlsafe()
+
+
+def _IsCached(kind):
+  """Whether lookups of the given kind go through the cache at all."""
+  return bool(TTLS.get(kind) or NEGATIVE_TTLS.get(kind))
+
+
+def Configure(negative_ttls=None, **ttls):
+  """Sets the cache time-to-live for some kinds.
+
+  Args:
+    negative_ttls: (dict) Mapping kind names to seconds to remember misses
+      for; 0 or None disables negative caching.
+    ttls: (dict) Mapping kind names to seconds; 0 or None disables caching.
+  """
+  TTLS.update(ttls)
+  NEGATIVE_TTLS.update(negative_ttls or {})
+
+
+@ndb.tasklet
+def GetAsync(key):
+  """Asynchronously retrieves an entity, from memcache if possible.
+
+  Several calls made together are batched into one memcache get and one
+  datastore get by ndb.
+
+  Args:
+    key: (ndb.Key) The key of the entity.
+
+  Returns:
+    (ndb.Future) Resolves to the entity, or None if it doesn't exist.
+  """
+  kind = key.kind()
+  if not _IsCached(kind) or ndb.in_transaction():
+    entity = yield key.get_async()
+    raise ndb.Return(entity)
+
+  ctx = ndb.get_context()
+  cache_key = _CacheKey(key)
+  cached = yield ctx.memcache_get(cache_key)
+  if cached == _MISSING:
+    STATS[kind, "negative_hits"] += 1
+    raise ndb.Return(None)
+  elif cached is not None:
+    STATS[kind, "hits"] += 1
+    raise ndb.Return(cached)
+  STATS[kind, "misses"] += 1
+  # This cache stands in for ndb's own memcache layer, which would otherwise
+  # cost a second memcache round trip on every miss. The models keep ndb's
+  # default policy, because mixing policies splits a put_multi into one
+  # datastore RPC per policy.
+  entity = yield key.get_async(use_memcache=False)
+  if entity is not None and TTLS.get(kind):
+    yield ctx.memcache_add(cache_key, entity, time=TTLS[kind])
+  elif entity is None and NEGATIVE_TTLS.get(kind):
+    yield ctx.memcache_add(cache_key, _MISSING, time=NEGATIVE_TTLS[kind])
+  raise ndb.Return(entity)
+
+
+def Invalidate(*keys):
+  """Drops entities from the cache once the current transaction commits.
+
+  Outside of a transaction, drops them immediately.
+
+  Args:
+    keys: (ndb.Key) The keys of entities that have been written.
+  """
+  cache_keys = [_CacheKey(key) for key in keys if _IsCached(key.kind())]
+  if cache_keys:
+    ndb.get_context().call_on_commit(
+        lambda: memcache.delete_multi(cache_keys, seconds=LOCK_SECONDS))
+
+
+def Store(entity):
+  """Caches an entity's current value, whether or not it has been written.
+
+  This lets readers see changes that are buffered rather than written; the
+  next Invalidate of the entity drops them. Like a read-through, it respects
+  the lock left by a recent Invalidate, so it never races a write.
+
+  Args:
+    entity: (ndb.Model) The entity.
+  """
+  kind = entity.key.kind()
+  if not TTLS.get(kind):
+    return
+  client = memcache.Client()
+  cache_key = _CacheKey(entity.key)
+  if client.gets(cache_key) is None:
+    client.add(cache_key, entity, time=TTLS[kind])
+  else:
+    client.cas(cache_key, entity, time=TTLS[kind])
+
+
+def _InboxVersionKey(uid):
+  """Returns the memcache key for a user's inbox version."""
+  return "inbox_version:{u}".format(u=uid)
+
+
+def GetInboxVersion(uid):
+  """Returns the version stamp of a user's inbox.
+
+  Versions start from the clock (in microseconds) whenever memcache has lost
+  track of one, so a version is never reused for different inbox contents.
+
+  Args:
+    uid: (int) The user's object id.
+
+  Returns:
+    (int) The version.
+  """
+  key = _InboxVersionKey(uid)
+  version = memcache.get(key)
+  if version is None:
+    memcache.add(key, int(time.time() * 1000000))
+    version = memcache.get(key)
+  return version
+
+
+def TouchInbox(*uids):
+  """Bumps users' inbox versions once the current transaction commits.
+
+  Call this whenever something visible in History changes.
+
+  Args:
+    uids: (int) The users' object ids.
+  """
+  deltas = dict((_InboxVersionKey(uid), 1) for uid in uids)
+  ndb.get_context().call_on_commit(lambda: memcache.offset_multi(deltas))
+
+
+def HistoryKey(uid, args):
+  """Returns the memcache key for a cached History result.
+
+  Args:
+    uid: (int) The user's object id.
+    args: (tuple) All of the other History arguments, in order.
+
+  Returns:
+    (str) The key, which embeds the user's current inbox version.
+  """
+  return "history:{u}:{v}:{a}".format(
+      u=uid, v=GetInboxVersion(uid), a=hashlib.md5(repr(args)).hexdigest())
+
+
+def Stats():
+  """Summarizes this instance's cache performance.
+
+  Returns:
+    (dict) Mapping kind names to dicts of hits, negative_hits, misses, and
+    hit_rate (which counts negative hits as hits).
+  """
+  stats = {}
+  for (kind, outcome), count in STATS.iteritems():
+    stats.setdefault(
+        kind, {"hits": 0, "negative_hits": 0, "misses": 0})[outcome] += count
+  for kind_stats in stats.itervalues():
+    hits = kind_stats["hits"] + kind_stats["negative_hits"]
+    total = hits + kind_stats["misses"]
+    kind_stats["hit_rate"] = float(hits) / total if total else 0.0
+  return stats
+
+
+class BlobCache(object):
+  """A per-instance LRU cache of file blobs, bounded by total size in bytes.
+
+  Entries are keyed by (kind, uid) and tagged with the content version they
+  were cached at; looking one up with any other version is a miss, so entries
+  for files rewritten by another instance are never served.
+  """
+
+  def __init__(self, max_bytes):
+    self.max_bytes = max_bytes
+    self.resident_bytes = 0
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self._entries = collections.OrderedDict()  # Least recently used first
+    self._lock = threading.Lock()
+
+  def _Drop(self, key):
+    """Removes an entry, if present. Call with the lock held."""
+    entry = self._entries.pop(key, None)
+    if entry is not None:
+      self.resident_bytes -= len(entry[1])
+    return entry
+
+  def Get(self, key, version):
+    """Looks up a blob.
+
+    Args:
+      key: (tuple) The (kind, uid) of the file.
+      version: (str) The current content version of the file.
+
+    Returns:
+      (str or None) The blob, or None on a miss.
+    """
+    with self._lock:
+      entry = self._Drop(key)
+      if entry is None or entry[0] != version:
+        self.misses += 1
+        return None
+      self._entries[key] = entry
+      self.resident_bytes += len(entry[1])
+      self.hits += 1
+      return entry[1]
+
+  def Put(self, key, version, blob):
+    """Caches a blob, evicting the least recently used ones to make room.
+
+    Args:
+      key: (tuple) The (kind, uid) of the file.
+      version: (str) The content version of the blob.
+      blob: (str) The file contents.
+    """
+    if len(blob) > self.max_bytes:
+      return
+    with self._lock:
+      self._Drop(key)
+      self._entries[key] = (version, blob)
+      self.resident_bytes += len(blob)
+      while self.resident_bytes > self.max_bytes:
+        self._Drop(next(iter(self._entries)))
+        self.evictions += 1
+
+  def Invalidate(self, key):
+    """Drops a blob from the cache.
+
+    Args:
+      key: (tuple) The (kind, uid) of the file.
+    """
+    with self._lock:
+      self._Drop(key)
+
+  def Stats(self):
+    """Summarizes the cache's performance.
+
+    Returns:
+      (dict) Hits, misses, hit_rate, evictions, entries and resident_bytes.
+    """
+    with self._lock:
+      total = self.hits + self.misses
+      return {
+          "hits": self.hits,
+          "misses": self.misses,
+          "hit_rate": float(self.hits) / total if total else 0.0,
+          "evictions": self.evictions,
+          "entries": len(self._entries),
+          "resident_bytes": self.resident_bytes}
+
+
+BLOBS = BlobCache(BLOB_CACHE_BYTES)
@@ -0,0 +1,151 @@
+# pylint: disable=missing-docstring,protected-access
+
+"""Tests for the memcache entity cache."""
+
+import unittest
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+from storage import cache
+from storage import interface
+from storage import model
+from test import testutils
+
+
+class CacheTest(unittest.TestCase):
+
+  @classmethod
+  def setUpClass(cls):
+    cls.api = testutils.TestApi()
+    testutils.FakeUsers(2)
+
+  @classmethod
+  def tearDownClass(cls):
+    cls.api.Stop()
+
+  def setUp(self):
+    memcache.flush_all()
+    cache.STATS.clear()
+
+  def testReadThrough(self):
+    key = interface.UKey(1)
+    self.assertEqual(key, cache.GetAsync(key).get_result().key)
+    ndb.get_context().clear_cache()
+    self.api.rpcs.clear()
+    self.assertEqual(key, cache.GetAsync(key).get_result().key)
+    self.assertEqual(0, self.api.rpcs["datastore_v3.Get"])
+    self.assertEqual(
+        {"User": {"hits": 1, "negative_hits": 0, "misses": 1, "hit_rate": 0.5}},
+        cache.Stats())
+
+    # A miss costs a single memcache lookup
+    ndb.get_context().clear_cache()
+    memcache.flush_all()
+    self.api.rpcs.clear()
+    cache.GetAsync(key).get_result()
+    self.assertEqual(1, self.api.rpcs["memcache.Get"])
+
+  def testMissing(self):
+    uid = model.User.allocate_ids(size=1)[0] + 1  # The next account's id
+    key = interface.UKey(uid)
+    self.assertEqual(None, cache.GetAsync(key).get_result())
+    ndb.get_context().clear_cache()
+    self.api.rpcs.clear()
+    with self.assertRaises(LookupError):
+      interface.GetUser(uid)
+    self.assertEqual(0, self.api.rpcs["datastore_v3.Get"])
+    self.assertEqual(1, cache.Stats()["User"]["negative_hits"])
+
+    # Creating the account clears the negative entry
+    user, _, _ = interface.CreateAccount("Foo", 0, 0)
+    self.assertEqual(uid, user.key.id())
+    ndb.get_context().clear_cache()
+    self.assertEqual("Foo", interface.GetUser(uid).name)
+
+  def testUncachedKinds(self):
+    rel_key = model.Relationship(id=2, parent=interface.UKey(1)).key
+    model.MessageFile(id=123, parent=rel_key, blob="abc123").put()
+    interface.GetForRelationship(model.MessageFile, 1, 2, 123)
+    self.assertEqual({}, cache.Stats())
+
+  def testTransactionsBypassCache(self):
+    key = interface.UKey(1)
+    ndb.transaction(lambda: cache.GetAsync(key).get_result())
+    self.assertEqual({}, cache.Stats())
+
+  def testStore(self):
+    match = interface.GetForUid(model.MatchParameters, 1)
+    match.latitude = 10
+    cache.Store(match)
+    self.assertEqual(10, interface.GetForUid(model.MatchParameters, 1).latitude)
+
+    # Stores racing a write don't put the entity back while it's locked
+    cache.Invalidate(match.key)
+    match.latitude = 20
+    cache.Store(match)
+    self.assertEqual(None, memcache.get(cache._CacheKey(match.key)))
+
+  def testInvalidate(self):
+    interface.GetUser(2)
+    interface.UpdateAccount(2, name="Renamed")
+    self.assertEqual("Renamed", interface.GetUser(2).name)
+    interface.GetForUid(model.MatchParameters, 2)
+    interface.Ping(2, 10, 20)
+    self.assertEqual(10, interface.GetForUid(model.MatchParameters, 2).latitude)
+
+
+class BlobCacheTest(unittest.TestCase):
+
+  def testLru(self):
+    blobs = cache.BlobCache(10)
+    blobs.Put(("IntroFile", 1), "v1", "aaaa")
+    blobs.Put(("IntroFile", 2), "v1", "bbbb")
+    self.assertEqual("aaaa", blobs.Get(("IntroFile", 1), "v1"))
+    blobs.Put(("IntroFile", 3), "v1", "cccc")  # Evicts the least recent, 2
+    self.assertEqual(None, blobs.Get(("IntroFile", 2), "v1"))
+    self.assertEqual("cccc", blobs.Get(("IntroFile", 3), "v1"))
+    self.assertEqual(8, blobs.Stats()["resident_bytes"])
+    self.assertEqual(1, blobs.Stats()["evictions"])
+    blobs.Put(("IntroFile", 4), "v1", "x" * 11)  # Too big to ever cache
+    self.assertEqual(None, blobs.Get(("IntroFile", 4), "v1"))
+
+  def testVersions(self):
+    blobs = cache.BlobCache(10)
+    blobs.Put(("IntroFile", 1), "v1", "aaaa")
+    self.assertEqual(None, blobs.Get(("IntroFile", 1), "v2"))
+    self.assertEqual(None, blobs.Get(("IntroFile", 1), "v1"))
+    blobs.Put(("IntroFile", 1), "v2", "bbbb")
+    blobs.Invalidate(("IntroFile", 1))
+    self.assertEqual(None, blobs.Get(("IntroFile", 1), "v2"))
+    stats = blobs.Stats()
+    self.assertEqual(0, stats["hits"])
+    self.assertEqual(3, stats["misses"])
+    self.assertEqual(0, stats["entries"])
+    self.assertEqual(0, stats["resident_bytes"])
+
+
+class BlobCacheInterfaceTest(unittest.TestCase):
+
+  @classmethod
+  def setUpClass(cls):
+    cls.api = testutils.TestApi()
+    testutils.FakeUsers(1)
+
+  @classmethod
+  def tearDownClass(cls):
+    cls.api.Stop()
+
+  def testIntroFiles(self):
+    intro = testutils.Resource("intro.aac")
+    interface.SetIntro(1, intro)
+    self.assertEqual(intro, interface.GetIntro(1))
+    hits = cache.BLOBS.hits
+    self.assertEqual(intro, interface.GetIntro(1))
+    self.assertEqual(hits + 1, cache.BLOBS.hits)
+    message = testutils.Resource("message.aac")
+    interface.SetIntro(1, message)
+    self.assertEqual(message, interface.GetIntro(1))
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,261 @@
+"""The inbound event logs that deliver messages and roses to their recipients.
+
+Sending writes an InboundEvent to a shard of the recipient's log, in the
+sender's transaction, instead of touching the recipient's entity group. The
+events are then folded into the recipient's relationships, UnreadTotals and
+received traces, right after the send or, for recipients under contention, in
+batches; see DeliverInbound. Until then, reads add the pending events back in;
+see GetPendingAsync.
+
+This module builds on storage.interface, which imports it in turn, so
+functions that need the interface import it when called.
+"""
+
+import collections
+import common
+import datetime
+import logging
+
+from google.appengine.api import datastore_errors
+from google.appengine.api import memcache
+from google.appengine.ext import deferred
+from google.appengine.ext import ndb
+from storage import cache
+from storage import model
+
+
+# Shards of each user's inbound event log. A sender always appends to the same
+# shard, and each shard is an entity group, so a recipient can take this many
+# times the sustained write rate of a single entity group.
+INBOUND_SHARDS = 16
+
+# Seconds between folds of a hot recipient's inbound events.
+FOLD_INTERVAL = 2
+
+# The most events applied to a recipient's relationships by one fold.
+FOLD_BATCH_SIZE = 100
+
+# Seconds to leave a recipient's events to batched folds after contention.
+HOT_RECIPIENT_SECONDS = 60
+
+# The FullRelationship and UnreadTotals counter for each kind of event.
+UNREAD_PROPERTIES = {"message": "new_messages", "rose": "new_roses"}
+
+
+def InboundLogKey(recipient, sender):
+  """Returns the key of the shard of a user's inbound log a sender writes to.
+
+  Args:
+    recipient: (int) The user object id of the log's owner.
+    sender: (int) The user object id of the sender.
+
+  Returns:
+    (ndb.Key) The model.InboundLog key.
+  """
+  return ndb.Key(model.InboundLog, "{r}:{s}".format(
+      r=recipient, s=sender % INBOUND_SHARDS))
+
+
+def InboundEventKey(recipient, sender, kind, ts):
+  """Returns the key of the inbound event for a message or rose.
+
+  Args:
+    recipient: (int) The user object id of the recipient.
+    sender: (int) The user object id of the sender.
+    kind: (str) "message" or "rose".
+    ts: (int) The send timestamp, in miliseconds since epoch.
+
+  Returns:
+    (ndb.Key) The model.InboundEvent key.
+  """
+  return ndb.Key(
+      model.InboundEvent, "{k}:{s}:{t}".format(k=kind, s=sender, t=ts),
+      parent=InboundLogKey(recipient, sender))
+
+
+def _PendingKey(uid, kind):
+  """Returns the memcache key counting a user's unfolded events of a kind."""
+  return "pending:{u}:{p}".format(u=uid, p=UNREAD_PROPERTIES[kind])
+
+
+@ndb.tasklet
+def GetPendingAsync(uid):
+  """Asynchronously counts a user's events that have yet to be folded.
+
+  Args:
+    uid: (int) The user's object id.
+
+  Returns:
+    (ndb.Future) Resolves to a dict of new_roses and new_messages counts.
+  """
+  ctx = ndb.get_context()
+  kinds = sorted(UNREAD_PROPERTIES)
+  counts = yield [ctx.memcache_get(_PendingKey(uid, kind)) for kind in kinds]
+  raise ndb.Return(dict(
+      (UNREAD_PROPERTIES[kind], int(count or 0))
+      for kind, count in zip(kinds, counts)))
+
+
+def _HotKey(uid):
+  """Returns the memcache key flagging a user as a hot recipient."""
+  return "hot_recipient:{u}".format(u=uid)
+
+
+def MarkHotRecipient(uid):
+  """Leaves a user's inbound events to batched folds for a while.
+
+  Args:
+    uid: (int) The user's object id.
+  """
+  memcache.set(_HotKey(uid), True, time=HOT_RECIPIENT_SECONDS)
+
+
+def DeliverInbound(event):
+  """Folds a newly sent message or rose into its recipient's relationship.
+
+  Call this once the sender's transaction has committed. The event is folded
+  right away unless that contends with other writes to the recipient, in which
+  case the recipient is marked hot and their events are folded in batches, at
+  most once every FOLD_INTERVAL seconds, until things quiet down. Any other
+  failure to fold also leaves the event to a scheduled fold, rather than
+  failing a send that has already happened.
+
+  Args:
+    event: (model.InboundEvent) The event.
+  """
+  memcache.incr(_PendingKey(event.recipient, event.kind), initial_value=0)
+  if not memcache.get(_HotKey(event.recipient)):
+    try:
+      FoldInbound(event.recipient, [event.key], retries=0)
+      return
+    except datastore_errors.TransactionFailedError:
+      MarkHotRecipient(event.recipient)
+    except Exception:  # pylint: disable=broad-except
+      # The send has committed, so leave the event to a scheduled fold
+      logging.exception("Failed to fold inbound event %s", event.key)
+  ScheduleFold(event.recipient)
+
+
+def ScheduleFold(uid):
+  """Schedules a fold of a user's inbound log at the end of this interval.
+
+  Args:
+    uid: (int) The user's object id.
+  """
+  from storage import interface
+  interface.DeferOncePerInterval(
+      FOLD_INTERVAL, "fold-{u}".format(u=uid), FoldInbound, uid)
+
+
+def FoldInbound(uid, event_keys=None, retries=None):
+  """Applies inbound events to a user's relationships, then deletes them.
+
+  Events that have already been applied, because a previous fold failed to
+  delete them, are skipped, so folding is idempotent.
+
+  Args:
+    uid: (int) The user's object id.
+    event_keys: (list of ndb.Key) The events to fold; by default, a batch of
+      whatever is in the user's log, chaining another fold if more remains.
+    retries: (int) Times to retry the transaction on contention.
+
+  Returns:
+    (int) The number of events applied.
+  """
+  from storage import interface
+  more = False
+  if event_keys is None:
+    futures = [
+        model.InboundEvent.query(
+            ancestor=InboundLogKey(uid, shard)).fetch_async(
+                FOLD_BATCH_SIZE, keys_only=True)
+        for shard in range(INBOUND_SHARDS)]
+    event_keys = [key for future in futures for key in future.get_result()]
+    more = len(event_keys) > FOLD_BATCH_SIZE
+    event_keys = event_keys[:FOLD_BATCH_SIZE]
+  events = [event for event in ndb.get_multi(event_keys) if event is not None]
+  if not events:
+    return 0
+
+  senders = set(event.sender for event in events)
+  futures = dict(
+      (sender, interface.GetUserAsync(sender)) for sender in senders)
+  partners = dict(
+      (sender, future.get_result()) for sender, future in futures.iteritems())
+  options = {} if retries is None else {"retries": retries}
+  applied = ndb.transaction(
+      lambda: _ApplyInboundEvents(uid, events, partners), **options)
+
+  # Decrement before deleting the events: a retry after a failed delete skips
+  # the events this fold applied, so it wouldn't decrement for them again.
+  pending = collections.Counter(
+      _PendingKey(uid, event.kind) for event in applied)
+  if pending:
+    memcache.offset_multi(
+        dict((key, -count) for key, count in pending.iteritems()))
+  ndb.delete_multi([event.key for event in events])
+  if more:
+    deferred.defer(FoldInbound, uid)
+  return len(applied)
+
+
+def _ApplyInboundEvents(uid, events, partners):
+  """Applies inbound events to a user's relationships; see FoldInbound.
+
+  Call this in a transaction. It only touches the recipient's entity group.
+
+  Args:
+    uid: (int) The recipient's object id.
+    events: (list of model.InboundEvent) The events.
+    partners: (dict) Mapping the senders' object ids to their model.User.
+
+  Returns:
+    (list of model.InboundEvent) The events that hadn't been applied before.
+  """
+  from storage import interface
+  totals_future = interface.GetUnreadTotalsAsync(uid)
+  rel_futures = dict(
+      (sender, interface.RelationshipAsync(uid, sender))
+      for sender in partners)
+  rels = dict(
+      (sender, future.get_result())
+      for sender, future in rel_futures.iteritems())
+  trace_keys = [
+      ndb.Key(
+          model.ReceivedMessage if event.kind == "message"
+          else model.ReceivedRose,
+          common.Milis(event.sent), parent=rels[event.sender].key)
+      for event in events]
+  traces = ndb.get_multi(trace_keys)
+  totals = totals_future.get_result()
+  folded = datetime.datetime.today()
+
+  applied = []
+  dirty = {}
+  for event, trace_key, trace in zip(events, trace_keys, traces):
+    if trace is not None:
+      continue
+    rel = rels[event.sender]
+    interface.CopyPartnerInfo(rel, partners[event.sender])
+    if event.kind == "message":
+      dirty[trace_key] = model.ReceivedMessage(key=trace_key)
+      rel.last_received_message = max(rel.last_received_message, event.sent)
+    else:
+      dirty[trace_key] = model.ReceivedRose(
+          key=trace_key, bloomed=event.bloomed, planted=event.planted)
+      rel.last_received_rose = max(rel.last_received_rose, event.sent)
+    rel.last_incoming = max(rel.last_incoming, event.sent)
+    rel.last_updated = max(rel.last_updated, event.sent, folded)
+    prop = UNREAD_PROPERTIES[event.kind]
+    setattr(rel, prop, getattr(rel, prop) + 1)
+    setattr(totals, prop, getattr(totals, prop) + 1)
+    interface.AddRecentEvent(rel, event.kind, False, trace_key.id())
+    dirty[rel.key] = rel
+    applied.append(event)
+
+  if applied:
+    dirty[totals.key] = totals
+    ndb.put_multi(dirty.values())
+    cache.Invalidate(totals.key)
+    cache.TouchInbox(uid)
+  return applied
@@ -0,0 +1,130 @@
+# pylint: disable=missing-docstring,protected-access
+
+"""Tests for the inbound event logs."""
+
+import common
+import datetime
+import unittest
+
+from google.appengine.api import datastore_errors
+from google.appengine.ext import ndb
+from storage import inbound
+from storage import interface
+from storage import model
+from test import testutils
+
+
+class InboundTest(unittest.TestCase):
+
+  @classmethod
+  def setUpClass(cls):
+    cls.api = testutils.TestApi()
+    testutils.FakeUsers(4)
+
+  @classmethod
+  def tearDownClass(cls):
+    cls.api.Stop()
+
+  def testHotRecipient(self):
+    audio = testutils.Resource("intro.aac")
+    now = datetime.datetime.today()
+    inbound.MarkHotRecipient(1)
+    interface.SendMessage(2, 1, audio, now=now)
+    interface.SendMessage(3, 1, audio, now=now)
+    interface.SendRose(2, 1, 1, now=now)
+
+    # Nothing has been folded yet, but reads include the pending events
+    self.assertEqual(0, interface.Relationship(1, 2).new_messages)
+    self.assertEqual(0, interface.GetUnreadTotals(1).new_messages)
+    self.assertEqual(
+        {"new_roses": 1, "new_messages": 2}, interface.GetBadge(1))
+    thread, _ = interface.Thread(1, 2)
+    self.assertEqual(
+        [(common.Milis(now), False, True)],
+        [(msg["send_timestamp_ms"], msg["sent"], msg["new"])
+         for msg in thread])
+
+    # A batched fold applies everything
+    self.api.RunTasks()
+    rel_2, rel_3 = interface.Relationship(1, 2), interface.Relationship(1, 3)
+    self.assertEqual((1, 1), (rel_2.new_messages, rel_2.new_roses))
+    self.assertEqual(1, rel_3.new_messages)
+    self.assertEqual(now, rel_2.last_incoming)
+    self.assertEqual("User_3", rel_3.partner_name)
+    self.assertEqual(
+        {"new_roses": 1, "new_messages": 2}, interface.GetBadge(1))
+    self.assertEqual(1, len(interface.Thread(1, 2)[0]))
+    self.assertEqual(0, inbound.FoldInbound(1))
+
+  def testFoldIsIdempotent(self):
+    audio = testutils.Resource("intro.aac")
+    now = datetime.datetime.today() + datetime.timedelta(10)
+    inbound.MarkHotRecipient(4)
+    interface.SendMessage(3, 4, audio, now=now)
+    key = inbound.InboundEventKey(4, 3, "message", common.Milis(now))
+    event = key.get()
+    self.assertEqual(1, inbound.FoldInbound(4, [key]))
+    event.put()  # As if deleting it had failed
+    self.assertEqual(0, inbound.FoldInbound(4, [key]))
+    self.assertEqual(None, key.get())
+    self.assertEqual(1, interface.Relationship(4, 3).new_messages)
+    self.assertEqual(1, interface.GetBadge(4)["new_messages"])
+
+  def testFailedDeleteKeepsBadge(self):
+    uid = interface.CreateAccount("Foo", 0, 0)[0].key.id()
+    inbound.MarkHotRecipient(uid)
+    interface.SendMessage(4, uid, testutils.Resource("intro.aac"))
+    badge = interface.GetBadge(uid)
+
+    def Fail(*_):
+      raise datastore_errors.InternalError("Delete failed")
+    delete_multi = ndb.delete_multi
+    ndb.delete_multi = Fail
+    try:
+      self.assertRaises(
+          datastore_errors.InternalError, inbound.FoldInbound, uid)
+    finally:
+      ndb.delete_multi = delete_multi
+    self.assertEqual(badge, interface.GetBadge(uid))
+    self.assertEqual(0, inbound.FoldInbound(uid))
+    self.assertEqual(badge, interface.GetBadge(uid))
+
+  def testFailedFoldIsScheduled(self):
+    def Fail(*_):
+      raise ValueError("Fold failed")
+    apply_inbound_events = inbound._ApplyInboundEvents
+    inbound._ApplyInboundEvents = Fail
+    try:
+      now = interface.SendMessage(
+          2, 3, testutils.Resource("intro.aac"),
+          now=datetime.datetime.today() + datetime.timedelta(30))
+    finally:
+      inbound._ApplyInboundEvents = apply_inbound_events
+    self.assertNotEqual(None, now)
+    self.assertEqual(1, interface.GetBadge(3)["new_messages"])
+    self.api.RunTasks()
+    self.assertEqual(1, interface.Relationship(3, 2).new_messages)
+
+  def testListenBeforeFold(self):
+    audio = testutils.Resource("intro.aac")
+    now = datetime.datetime.today() + datetime.timedelta(20)
+    inbound.MarkHotRecipient(2)
+    interface.SendMessage(4, 2, audio, now=now)
+    self.assertEqual(audio, interface.GetMessageFile(4, 2, now, False))
+
+    # Record the retrieval before the scheduled fold gets to run.
+    interface.RecordRetrieval(4, 2, now, now)
+    self.assertEqual([], model.InboundEvent.query(
+        ancestor=inbound.InboundLogKey(2, 4)).fetch())
+    self.assertEqual(
+        1, interface.GetForRelationship(
+            model.ReceivedMessage, 2, 4, now).retrieval_count)
+    self.api.RunTasks()
+    self.assertEqual(0, interface.Relationship(2, 4).new_messages)
+    self.assertFalse(
+        interface.GetForRelationship(model.ReceivedMessage, 2, 4, now).new)
+    self.assertEqual(0, interface.GetBadge(2)["new_messages"])
+
+
+if __name__ == "__main__":
+  unittest.main()
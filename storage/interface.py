@@ -1,10 +1,20 @@
 """Interface for retrieving and writing data to Datastore."""
 
+import collections
 import common
 import datetime
+import hashlib
+import json
+import logging
 import random
+import time
 
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.ext import deferred
 from google.appengine.ext import ndb
+from storage import cache
+from storage import inbound
 from storage import model
 
 
@@ -41,6 +51,22 @@ def UKey(uid):
   return ndb.Key(model.User, uid)
 
 
+@ndb.tasklet
+def GetUserAsync(uid):
+  """Asynchronously retrieves the model.User object for a given user id.
+
+  Reads through the memcache entity cache; see storage.cache.
+
+  Args:
+    uid: (int) The user's object id.
+
+  Returns:
+    (ndb.Future) Resolves to the model.User object.
+  """
+  user = yield cache.GetAsync(UKey(uid))
+  raise ndb.Return(Guarantee(user))
+
+
 def GetUser(uid):
   """Retrieves the model.User object for a given user id from the datastore.
 
@@ -50,7 +76,24 @@ def GetUser(uid):
   Returns:
     (model.User) The user object.
   """
-  return Guarantee(model.User.get_by_id(uid))
+  return GetUserAsync(uid).get_result()
+
+
+@ndb.tasklet
+def GetForUidAsync(model_class, uid):
+  """Asynchronously retrieves a model.* for a given user id.
+
+  Reads through the memcache entity cache; see storage.cache.
+
+  Args:
+    model_class: (class) A subclass of ndb.Model.
+    uid: (int) The user's object id.
+
+  Returns:
+    (ndb.Future) Resolves to the retrieved model.
+  """
+  obj = yield cache.GetAsync(ndb.Key(model_class, 1, parent=UKey(uid)))
+  raise ndb.Return(Guarantee(obj))
 
 
 def GetForUid(model_class, uid):
@@ -66,7 +109,36 @@ def GetForUid(model_class, uid):
   Returns:
     (model_class) The retrieved model.
   """
-  return Guarantee(model_class.get_by_id(1, parent=UKey(uid)))
+  return GetForUidAsync(model_class, uid).get_result()
+
+
+@ndb.tasklet
+def RelationshipAsync(agent, patient, full=True):
+  """Asynchronously retrieves or creates a relationship for two users.
+
+  Args:
+    agent: (int) The user object id of the actor or sender.
+    patient: (int) The user object id of the patient or recipient.
+    full: (bool) True to access the full relationship.
+
+  Returns:
+    (ndb.Future) Resolves to the model.Relationship or
+    model.FullRelationship.
+  """
+  if agent == patient:
+    raise ValueError("A user has no relationship with itself.")
+  cls = model.FullRelationship if full else model.Relationship
+  obj = cls(id=patient, parent=UKey(agent))
+  retrieved = yield obj.key.get_async()
+  if retrieved is None:
+    raise ndb.Return(obj)
+  elif full and not isinstance(retrieved, model.FullRelationship):
+    # Upgrade a relationship that so far only has profile visits.
+    obj.last_visited = retrieved.last_visited
+    obj.last_visited_by = retrieved.last_visited_by
+    raise ndb.Return(obj)
+  else:
+    raise ndb.Return(retrieved)
 
 
 def Relationship(agent, patient, full=True):
@@ -83,15 +155,24 @@ def Relationship(agent, patient, full=True):
   Returns:
     (model.Relationship or model.FullRelationship) The relationship.
   """
-  if agent == patient:
-    raise ValueError("A user has no relationship with itself.")
-  cls = model.FullRelationship if full else model.Relationship
-  obj = cls(id=patient, parent=UKey(agent))
-  retrieved = obj.key.get()
-  if retrieved is not None:
-    return retrieved
-  else:
-    return obj
+  return RelationshipAsync(agent, patient, full=full).get_result()
+
+
+@ndb.tasklet
+def RelationshipsAsync(sender, recipient, full=True):
+  """Asynchronously retrieves a pair of relationships, in parallel.
+
+  Args:
+    sender: (int) The user object id of the arbitrarily chosen sender.
+    recipient: (int) The user object id of the arbitrarily chosen recipient.
+    full: (bool) True to access the full relationship.
+
+  Returns:
+    (ndb.Future) Resolves to the pair of relationships; see Relationships.
+  """
+  rels = yield (RelationshipAsync(sender, recipient, full=full),
+                RelationshipAsync(recipient, sender, full=full))
+  raise ndb.Return(tuple(rels))
 
 
 def Relationships(sender, recipient, full=True):
@@ -107,16 +188,14 @@ def Relationships(sender, recipient, full=True):
     with the "sender" in the agent roll in the first element, and the "patient"
     in the agent roll in the second.
   """
-  return (Relationship(sender, recipient, full=full),
-          Relationship(recipient, sender, full=full))
+  return RelationshipsAsync(sender, recipient, full=full).get_result()
 
 
-def GetForRelationship(model_class, agent, patient, ts):
-  """Retrieves a model.* for a given rel. and timestamp from the datastore.
+@ndb.tasklet
+def GetForRelationshipAsync(model_class, agent, patient, ts):
+  """Asynchronously retrieves a model.* for a given rel. and timestamp.
 
-  This only works for objects that have a relationship as their ancestor and
-  are keyed by timestamp, including SentMessage, ReceivedMessage, SentRose,
-  ReceivedRose, and MessageFile.
+  Reads through the memcache entity cache; see storage.cache.
 
   Args:
     model_class: (class) A subclass of ndb.Model.
@@ -125,7 +204,7 @@ def GetForRelationship(model_class, agent, patient, ts):
     ts: (int or datetime.datetime) Timestamp of the object to be retrieved.
 
   Returns:
-    (model_class) The retrieved model.
+    (ndb.Future) Resolves to the retrieved model.
   """
   if agent == patient:
     raise ValueError("A user has no relationship with itself.")
@@ -133,13 +212,110 @@ def GetForRelationship(model_class, agent, patient, ts):
   if isinstance(ts, datetime.datetime):
     ts = common.Milis(ts)
   parent_key = model.Relationship(id=patient, parent=UKey(agent)).key
-  return Guarantee(model_class.get_by_id(ts, parent=parent_key))
+  obj = yield cache.GetAsync(ndb.Key(model_class, ts, parent=parent_key))
+  raise ndb.Return(Guarantee(obj))
+
+
+def GetForRelationship(model_class, agent, patient, ts):
+  """Retrieves a model.* for a given rel. and timestamp from the datastore.
+
+  This only works for objects that have a relationship as their ancestor and
+  are keyed by timestamp, including SentMessage, ReceivedMessage, SentRose,
+  ReceivedRose, and MessageFile.
+
+  Args:
+    model_class: (class) A subclass of ndb.Model.
+    agent: (int) The user object id of the agent.
+    patient: (int) The user object id of the patient.
+    ts: (int or datetime.datetime) Timestamp of the object to be retrieved.
+
+  Returns:
+    (model_class) The retrieved model.
+  """
+  return GetForRelationshipAsync(model_class, agent, patient, ts).get_result()
+
+
+# The number of events kept in each FullRelationship's recent summary.
+RECENT_EVENTS_CAP = 5
+
+
+def AddRecentEvent(rel, kind, sent, ts):
+  """Adds a message or rose to a relationship's recent summary.
+
+  Args:
+    rel: (model.FullRelationship) The relationship.
+    kind: (str) "message" or "rose".
+    sent: (bool) Whether the relationship's agent sent it.
+    ts: (int) The send timestamp, in miliseconds since epoch.
+  """
+  recent = rel.recent + [
+      model.RecentEvent(kind=kind, sent=sent, timestamp_ms=ts, new=True)]
+  recent.sort(key=lambda event: event.timestamp_ms, reverse=True)
+  rel.recent = recent[:RECENT_EVENTS_CAP]
+
+
+def DeferOncePerInterval(seconds, name, func, *args):
+  """Defers a function to the end of the current interval, at most once.
+
+  Calls made with the same name during the same interval share one task.
+
+  Args:
+    seconds: (int) The length of the interval.
+    name: (str) Names the task, along with the interval.
+    func: (function) The function to defer.
+    args: (list) Arguments for the function.
+  """
+  now = time.time()
+  interval = int(now / seconds)
+  try:
+    deferred.defer(
+        func, *args,
+        _name="{n}-{i}".format(n=name, i=interval),
+        _countdown=(interval + 1) * seconds - now)
+  except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+    pass
+
+
+def MarkRecentEventRead(rel, kind, ts):
+  """Clears the new flag of an event in a relationship's recent summary.
+
+  Args:
+    rel: (model.FullRelationship) The relationship.
+    kind: (str) "message" or "rose".
+    ts: (int) The send timestamp, in miliseconds since epoch.
+
+  Returns:
+    (bool) Whether the summary changed.
+  """
+  changed = False
+  for event in rel.recent:
+    if event.kind == kind and event.timestamp_ms == ts and event.new:
+      event.new = False
+      changed = True
+  return changed
 
 
 # --------------------------------------------------------------------------- #
 # Working with user accounts.                                                 #
 # --------------------------------------------------------------------------- #
 
+@ndb.tasklet
+def LoadAccountAsync(uid):
+  """Asynchronously loads all of a user's account info, with parallel gets.
+
+  Args:
+    uid: (int) The user's object id.
+
+  Returns:
+    (ndb.Future) Resolves to the (model.User, model.MatchParameters,
+    model.SearchSettings) triple.
+  """
+  account = yield (GetUserAsync(uid),
+                   GetForUidAsync(model.MatchParameters, uid),
+                   GetForUidAsync(model.SearchSettings, uid))
+  raise ndb.Return(tuple(account))
+
+
 def LoadAccount(uid):
   """Loads all of a user's account info.
 
@@ -147,19 +323,69 @@ def LoadAccount(uid):
     uid: (int) The user's object id.
 
   Returns:
-    (dict) Account information.
+    (model.User, model.MatchParameters, model.SearchSettings) The account.
   """
-  user = GetUser(uid)
-  match = GetForUid(model.MatchParameters, uid)
-  search = GetForUid(model.SearchSettings, uid)
-  return user, match, search
+  return LoadAccountAsync(uid).get_result()
+
+
+# Accounts written per put_multi by CreateAccounts.
+ACCOUNT_BATCH_SIZE = 100
+
+
+def _NewAccount(uid, profile, now):
+  """Builds the objects for a new account, without writing them.
+
+  Args:
+    uid: (int) The new user's object id, already allocated.
+    profile: (dict) The latitude and longitude, and any properties that can be
+      set with UpdateAccount.
+    now: (datetime.datetime) The time the user joined.
+
+  Returns:
+    (list of ndb.Model) The model.User, model.MatchParameters,
+    model.SearchSettings, model.Garden and model.UnreadTotals.
+  """
+  profile = dict(profile)
+  latitude = profile.pop("latitude")
+  longitude = profile.pop("longitude")
+  updates = _SortAccountProperties(profile)
+  user_key = UKey(uid)
+  return [
+      model.User(key=user_key, joined=now, **updates[model.User]),
+      model.MatchParameters(
+          id=1, parent=user_key, last_activity=now,
+          latitude=latitude, longitude=longitude,
+          **updates[model.MatchParameters]),
+      model.SearchSettings(
+          id=1, parent=user_key, **updates[model.SearchSettings]),
+      # Plant the garden
+      model.Garden(
+          id=1, parent=user_key,
+          roses=[model.Rose(bloomed=now, planted=now) for _ in (1, 2, 3)]),
+      model.UnreadTotals(id=1, parent=user_key)]
+
+
+def _ForgetMissing(entities):
+  """Drops cached failed lookups of new users' objects.
+
+  Args:
+    entities: (list of ndb.Model) Objects of new accounts, including the Users.
+  """
+  keys = [entity.key for entity in entities]
+  for entity in entities:
+    if isinstance(entity, model.User):
+      keys.extend([
+          ndb.Key(model.IntroFile, 1, parent=entity.key),
+          ndb.Key(model.ImageFile, 1, parent=entity.key)])
+  cache.Invalidate(*keys)
 
 
-# pylint: disable=no-value-for-parameter
-@ndb.transactional(xg=True)
 def CreateAccount(name, latitude, longitude, now=None):
   """Create a new account.
 
+  The user id is allocated up front, so all of the account's objects are
+  written by a single put_multi, in one transaction on the user's group.
+
   Args:
     name: (str) The user's nickname.
     latitude: (float) Degress latitude.
@@ -171,91 +397,276 @@ def CreateAccount(name, latitude, longitude, now=None):
     created user.
   """
   now = now or datetime.datetime.today()
-  user = model.User(name=name, joined=now)
-  user.put()
-  match = model.MatchParameters(
-      id=1, parent=user.key, last_activity=now,
-      latitude=latitude, longitude=longitude)
-  match.put()
-  search = model.SearchSettings(id=1, parent=user.key)
-  search.put()
+  uid, _ = model.User.allocate_ids(size=1)
+  entities = _NewAccount(
+      uid, {"name": name, "latitude": latitude, "longitude": longitude}, now)
+  ndb.transaction(lambda: ndb.put_multi(entities))
+  _ForgetMissing(entities)
+  return tuple(entities[:3])
 
-  # Plant the garden
-  rose_kwargs = {
-      "parent": model.Garden(id=1, parent=user.key).key,
-      "bloomed": now,
-      "planted": now}
-  model.Rose(id=1, **rose_kwargs).put()
-  model.Rose(id=2, **rose_kwargs).put()
-  model.Rose(id=3, **rose_kwargs).put()
 
-  return user, match, search
+def CreateAccounts(profiles, now=None):
+  """Creates many accounts at once.
 
+  User ids are allocated with a single call, and accounts are written
+  ACCOUNT_BATCH_SIZE at a time with put_multi. The writes aren't
+  transactional, so if this fails partway through, some of the accounts will
+  exist and some won't.
 
-@ndb.transactional
-def UpdateAccount(uid, **kwargs):
-  """Update's a users User, MatchParameters, and SearchSettings objects.
+  Args:
+    profiles: (list of dict) For each user, the name, latitude and longitude,
+      and any other properties that can be set with UpdateAccount.
+    now: (datetime.datetime) To peg the current time; for testing.
+
+  Returns:
+    (list of tuple) The (model.User, model.MatchParameters,
+    model.SearchSettings) of each new user, with user ids in the order of
+    profiles.
+  """
+  if not profiles:
+    return []
+  now = now or datetime.datetime.today()
+  first, _ = model.User.allocate_ids(size=len(profiles))
+  accounts = [
+      _NewAccount(first + i, profile, now)
+      for i, profile in enumerate(profiles)]
+  for start in range(0, len(accounts), ACCOUNT_BATCH_SIZE):
+    batch = [
+        entity for account in accounts[start:start + ACCOUNT_BATCH_SIZE]
+        for entity in account]
+    ndb.put_multi(batch)
+    _ForgetMissing(batch)
+  return [tuple(account[:3]) for account in accounts]
+
+
+# User properties copied onto the relationships partners have with the user.
+PARTNER_INFO_PROPERTIES = ("name", "image_hash")
+
+# Relationships updated per task when fanning out changes to partner info.
+FAN_OUT_BATCH_SIZE = 100
+
+# Account properties that can't be set through UpdateAccount.
+UNSETTABLE_ACCOUNT_PROPERTIES = (
+    "joined", "last_activity", "latitude", "longitude")
+
+
+# The account objects that UpdateAccount can change.
+ACCOUNT_CLASSES = (model.User, model.MatchParameters, model.SearchSettings)
+
+
+def _SortAccountProperties(kwargs):
+  """Works out which account object each property belongs to.
 
   Args:
-    uid: (int) The user's object id.
-    kwargs: (dict) Mapping properties to be updated to values.
+    kwargs: (dict) Mapping properties to values.
 
   Returns:
-    (model.User, model.MatchParameters, model.SearchSettings) The newly
-    updated objects.
+    (dict) Mapping each of ACCOUNT_CLASSES to a dict of its properties' values.
+
+  Raises:
+    ValueError: If a property can't be set, or doesn't exist.
   """
   # pylint: disable=protected-access
-  # Load the needed objects
-  user, match, search = None, None, None
+  updates = dict((cls, {}) for cls in ACCOUNT_CLASSES)
   for argname, val in kwargs.iteritems():
-    if argname in ("joined", "last_activity", "latitude", "longitude"):
+    if argname in UNSETTABLE_ACCOUNT_PROPERTIES:
       raise ValueError(
           "You can't set {a} in UpdateAccount.".format(a=argname))
-    elif argname in model.User._properties:
-      if not user:
-        user = GetUser(uid)
-      setattr(user, argname, val)
-    elif argname in model.MatchParameters._properties:
-      if not match:
-        match = GetForUid(model.MatchParameters, uid)
-      setattr(match, argname, val)
-    elif argname in model.SearchSettings._properties:
-      if not search:
-        search = GetForUid(model.SearchSettings, uid)
-      setattr(search, argname, val)
+    for cls in ACCOUNT_CLASSES:
+      if argname in cls._properties:
+        updates[cls][argname] = val
+        break
     else:
       raise ValueError(
           "'{a}' not found in User, MatchParameters, or SearchSettings".format(
               a=argname))
+  return updates
+
+
+@ndb.transactional_tasklet
+def UpdateAccountAsync(uid, **kwargs):
+  """Asynchronously updates a user's account objects; see UpdateAccount.
+
+  The objects touched by the update are loaded with one get_multi, and those
+  that actually change are written back with one put_multi. If nothing
+  changes, nothing is written.
+
+  Args:
+    uid: (int) The user's object id.
+    kwargs: (dict) Mapping properties to be updated to values.
+
+  Returns:
+    (ndb.Future) Resolves to the (model.User, model.MatchParameters,
+    model.SearchSettings) triple; objects that weren't changed are None.
+  """
+  # Work out which objects need updating
+  updates = _SortAccountProperties(kwargs)
+
+  # Load the needed objects
+  needed = [cls for cls in ACCOUNT_CLASSES if updates[cls]]
+  loaded = yield ndb.get_multi_async([
+      UKey(uid) if cls is model.User else ndb.Key(cls, 1, parent=UKey(uid))
+      for cls in needed])
+
+  # Apply only the values that differ
+  changed = {}
+  partner_info_changed = False
+  for cls, entity in zip(needed, loaded):
+    Guarantee(entity)
+    diffs = dict(
+        (argname, val) for argname, val in updates[cls].iteritems()
+        if getattr(entity, argname) != val)
+    if not diffs:
+      continue
+    if cls is model.User:
+      partner_info_changed = any(
+          prop in diffs for prop in PARTNER_INFO_PROPERTIES)
+    entity.populate(**diffs)
+    changed[cls] = entity
 
   # Send updates to the db.
-  for entity in (user, match, search):
-    if entity:
-      entity.put()
+  if changed:
+    yield ndb.put_multi_async(changed.values())
+    cache.Invalidate(*[entity.key for entity in changed.itervalues()])
+  if partner_info_changed:
+    deferred.defer(FanOutPartnerInfo, uid, _transactional=True)
 
   # Return changed objects
-  return user, match, search
+  raise ndb.Return(tuple(changed.get(cls) for cls in ACCOUNT_CLASSES))
 
 
-def Ping(uid, latitude, longitude):
+def UpdateAccount(uid, **kwargs):
+  """Update's a users User, MatchParameters, and SearchSettings objects.
+
+  Args:
+    uid: (int) The user's object id.
+    kwargs: (dict) Mapping properties to be updated to values.
+
+  Returns:
+    (model.User, model.MatchParameters, model.SearchSettings) The newly
+    updated objects.
+  """
+  return UpdateAccountAsync(uid, **kwargs).get_result()
+
+
+# Pings that move a user less than this many miles from their last written
+# location, within PING_FRESHNESS of their last written activity, are only
+# buffered in memcache.
+PING_DISTANCE_MILES = 0.25
+PING_FRESHNESS = datetime.timedelta(minutes=10)
+
+# Per-instance counts of "written" and "suppressed" pings.
+PING_STATS = collections.Counter()
+
+
+def _LastPingKey(uid):
+  """Returns the memcache key for a user's last written ping."""
+  return "last_ping:{u}".format(u=uid)
+
+
+def Ping(uid, latitude, longitude, now=None):
   """Sets a user's location and last active date.
 
+  Writes are coalesced: a ping close in time and space to the last one that
+  was written only updates the MatchParameters in the memcache entity cache,
+  so readers still see it.
+
   Args:
     uid: (int) The user's object id.
     latitude: (float) Degress latitude.
     longitude: (float) Degrees longitude.
+    now: (datetime.datetime) To peg the current time; for testing.
 
   Returns:
     (model.MatchParameters) The newly updated match params.
   """
-  match = GetForUid(model.MatchParameters, uid)
+  now = now or datetime.datetime.today()
+  last_future = ndb.get_context().memcache_get(_LastPingKey(uid))
+  match = GetForUidAsync(model.MatchParameters, uid).get_result()
+  last = last_future.get_result()  # Forgotten pings are always written
   match.latitude = latitude
   match.longitude = longitude
-  match.last_activity = datetime.datetime.today()
+  match.last_activity = now
+
+  if last is not None and now - last[2] < PING_FRESHNESS and common.Miles(
+      last[0], last[1], latitude, longitude) < PING_DISTANCE_MILES:
+    PING_STATS["suppressed"] += 1
+    cache.Store(match)
+    return match
+
+  PING_STATS["written"] += 1
   match.put()
+  cache.Invalidate(match.key)
+  memcache.set(
+      _LastPingKey(uid), (latitude, longitude, now),
+      time=int(PING_FRESHNESS.total_seconds()))
   return match
 
 
+def PingStats():
+  """Summarizes this instance's ping coalescing.
+
+  Returns:
+    (dict) The written and suppressed counts, and suppression_rate.
+  """
+  total = PING_STATS["written"] + PING_STATS["suppressed"]
+  return {
+      "written": PING_STATS["written"],
+      "suppressed": PING_STATS["suppressed"],
+      "suppression_rate": (
+          float(PING_STATS["suppressed"]) / total if total else 0.0)}
+
+
+# pylint: disable=no-value-for-parameter
+@ndb.transactional
+def _SetFile(model_class, hash_prop, uid, blob):
+  """Writes one of a user's files, and records its content hash on the user.
+
+  Args:
+    model_class: (class) model.IntroFile or model.ImageFile.
+    hash_prop: (str) The model.User property holding the file's hash.
+    uid: (int) The user's object id.
+    blob: (str) The file contents.
+  """
+  user = GetUser(uid)
+  old_hash = getattr(user, hash_prop)
+  setattr(user, hash_prop, hashlib.sha1(blob).hexdigest())
+  file_obj = model_class(id=1, parent=user.key, blob=blob)
+  ndb.put_multi([user, file_obj])
+  cache.Invalidate(user.key, file_obj.key)
+  # pylint: disable=protected-access
+  cache.BLOBS.Invalidate((model_class._get_kind(), uid))
+  changed = getattr(user, hash_prop) != old_hash
+  if changed and hash_prop in PARTNER_INFO_PROPERTIES:
+    deferred.defer(FanOutPartnerInfo, uid, _transactional=True)
+
+
+def _GetFile(model_class, hash_prop, uid):
+  """Reads one of a user's files, through the per-instance blob cache.
+
+  The cache is keyed by the content hash recorded on the (memcached) user, so
+  files rewritten elsewhere are never served stale. Files that predate content
+  hashes aren't cached.
+
+  Args:
+    model_class: (class) model.IntroFile or model.ImageFile.
+    hash_prop: (str) The model.User property holding the file's hash.
+    uid: (int) The user's object id.
+
+  Returns:
+    (str) The file contents.
+  """
+  version = getattr(GetUser(uid), hash_prop)
+  # pylint: disable=protected-access
+  cache_key = (model_class._get_kind(), uid)
+  blob = cache.BLOBS.Get(cache_key, version) if version else None
+  if blob is None:
+    blob = GetForUid(model_class, uid).blob
+    if version:
+      cache.BLOBS.Put(cache_key, version, blob)
+  return blob
+
+
 def SetIntro(uid, blob):
   """Sets a user's audio intro.
 
@@ -265,163 +676,788 @@ def SetIntro(uid, blob):
   """
   blob = str(blob)
   #TODO validate file format and size
-  user_key = UKey(uid)
-  intro = model.IntroFile(id=1, parent=user_key, blob=blob)
-  intro.put()
+  _SetFile(model.IntroFile, "intro_hash", uid, blob)
+
+
+def GetIntro(uid):
+  """Gets a user's audio intro.
+
+  Args:
+    uid: (int) The user's object id.
+
+  Returns:
+    (str) Raw AAC file bytestring
+  """
+  return _GetFile(model.IntroFile, "intro_hash", uid)
+
+
+def SetImage(uid, blob):
+  """Sets a user's chat image.
+
+  Args:
+    uid: (int) The user's object id.
+    blob: (unicode) Raw png file bytestring.
+  """
+  blob = str(blob)
+  #TODO validate file format and size, and image dimensions
+  _SetFile(model.ImageFile, "image_hash", uid, blob)
+
+
+def GetImage(uid):
+  """Gets a user's chat image.
+
+  Args:
+    uid: (int) The user's object id.
+
+  Returns:
+    (str) Raw png file bytestring
+  """
+  return _GetFile(model.ImageFile, "image_hash", uid)
+
+
+def FillPartnerInfo(*rels):
+  """Copies partner names and image hashes onto relationships that lack them.
+
+  Inside a transaction, this reads the partners' User objects transactionally,
+  so a concurrent change to them makes the transaction retry; transactions
+  that don't otherwise touch the partners should read them beforehand and use
+  CopyPartnerInfo.
+
+  Args:
+    rels: (model.FullRelationship) The relationships; this doesn't write them.
+  """
+  missing = [rel for rel in rels if rel.partner_name is None]
+  futures = [GetUserAsync(rel.key.id()) for rel in missing]
+  for rel, future in zip(missing, futures):
+    CopyPartnerInfo(rel, future.get_result())
+
+
+def CopyPartnerInfo(rel, partner):
+  """Copies a partner's name and image hash onto a relationship that lacks them.
+
+  Args:
+    rel: (model.FullRelationship) The relationship; this doesn't write it.
+    partner: (model.User) The relationship's patient.
+  """
+  if rel.partner_name is None:
+    rel.partner_name = partner.name
+    rel.partner_image_hash = partner.image_hash
+
+
+@ndb.transactional_tasklet
+def _SetPartnerInfoAsync(rel_key, name, image_hash):
+  """Asynchronously updates the partner info copied onto one relationship.
+
+  Args:
+    rel_key: (ndb.Key) The relationship's key.
+    name: (str) The partner's current name.
+    image_hash: (str) The partner's current image hash.
+
+  Returns:
+    (ndb.Future) Resolves once the relationship is up to date.
+  """
+  rel = yield rel_key.get_async()
+  if not isinstance(rel, model.FullRelationship):
+    return
+  if (rel.partner_name, rel.partner_image_hash) == (name, image_hash):
+    return
+  rel.partner_name = name
+  rel.partner_image_hash = image_hash
+  rel.last_updated = max(rel.last_updated, datetime.datetime.today())
+  yield rel.put_async()
+  cache.TouchInbox(rel_key.parent().id())
+
+
+def FanOutPartnerInfo(uid, cursor=None):
+  """Copies a user's name and image hash onto their partners' relationships.
+
+  Runs as a deferred task after either changes, handling a batch of partners
+  and then chaining another task for the rest.
+
+  Args:
+    uid: (int) The user's object id.
+    cursor: (str) Where the previous batch left off.
+  """
+  user = GetUser(uid)
+  keys, next_cursor, more = model.FullRelationship.query(
+      ancestor=UKey(uid)).fetch_page(
+          FAN_OUT_BATCH_SIZE, keys_only=True,
+          start_cursor=ndb.Cursor(urlsafe=cursor) if cursor else None)
+  futures = [
+      _SetPartnerInfoAsync(
+          ndb.Key(model.Relationship, uid, parent=UKey(key.id())),
+          user.name, user.image_hash)
+      for key in keys]
+  for future in futures:
+    future.get_result()
+  if more and next_cursor:
+    deferred.defer(FanOutPartnerInfo, uid, next_cursor.urlsafe())
+
+
+# --------------------------------------------------------------------------- #
+# Working with messages.                                                      #
+# --------------------------------------------------------------------------- #
+
+# Seconds to wait before checking whether a send that failed ambiguously left
+# its audio behind.
+MESSAGE_FILE_GC_DELAY = 60
+
+# Per-instance counts of attempts, commits, failures and total milliseconds
+# spent, keyed by (transaction name, measure).
+TRANSACTION_STATS = collections.Counter()
+
+
+def TransactionStats():
+  """Summarizes this instance's transaction performance.
+
+  Returns:
+    (dict) Mapping transaction names to dicts of attempts, commits, failures,
+    retry_rate (attempts beyond the first, per transaction) and mean_ms.
+  """
+  stats = {}
+  for (name, measure), count in TRANSACTION_STATS.iteritems():
+    stats.setdefault(name, {
+        "attempts": 0, "commits": 0, "failures": 0,
+        "milliseconds": 0})[measure] += count
+  for name_stats in stats.itervalues():
+    runs = name_stats["commits"] + name_stats["failures"]
+    name_stats["retry_rate"] = (
+        float(name_stats["attempts"] - runs) / runs if runs else 0.0)
+    name_stats["mean_ms"] = (
+        float(name_stats.pop("milliseconds")) / runs if runs else 0.0)
+  return stats
+
+
+def CanMessage(sender_rel, recipient_rel):
+  """Determines whether one user is allowed to message another.
+
+  Args:
+    sender_rel: (model.Relationship) With sender as agent.
+    recipient_rel: (model.Relationship) With recipient as agent.
+
+  Returns:
+    (bool) True if the sender is allowed to message the recipient.
+  """
+  #TODO
+  return True
+
+
+# Seconds for which a send made with an idempotency key is remembered, both in
+# memcache and by its datastore marker. Older markers are ignored, and deleted
+# when they're next looked up.
+IDEMPOTENCY_TTL = 24 * 60 * 60
+
+
+def IdempotencyMarkerKey(uid, action, idempotency_key):
+  """Returns the key of a model.IdempotencyMarker.
+
+  Args:
+    uid: (int) The sender's object id.
+    action: (str) "message" or "rose".
+    idempotency_key: (str) The key supplied by the client.
+
+  Returns:
+    (ndb.Key) The key.
+  """
+  return ndb.Key(
+      model.IdempotencyMarker,
+      "{a}:{k}".format(a=action, k=idempotency_key),
+      parent=UKey(uid))
+
+
+def _IdempotencyCacheKey(uid, action, idempotency_key):
+  """Returns the memcache key for the outcome of an idempotent send."""
+  return "idempotency:{u}:{a}:{k}".format(
+      u=uid, a=action, k=idempotency_key)
+
+
+def _IdempotencyMarkerAge(marker):
+  """Returns the seconds since an idempotency marker was written."""
+  # Markers written before created was added only have their send time.
+  created = marker.created or marker.sent
+  return (datetime.datetime.today() - created).total_seconds()
+
+
+def LookupIdempotentSend(uid, action, idempotency_key):
+  """Finds the send time recorded for an idempotency key, if any.
+
+  Args:
+    uid: (int) The sender's object id.
+    action: (str) "message" or "rose".
+    idempotency_key: (str) The key supplied by the client.
+
+  Returns:
+    (datetime.datetime or None) The original send time, or None if no send
+    with the key has committed within the last IDEMPOTENCY_TTL seconds.
+  """
+  cache_key = _IdempotencyCacheKey(uid, action, idempotency_key)
+  sent = memcache.get(cache_key)
+  if sent is None:
+    key = IdempotencyMarkerKey(uid, action, idempotency_key)
+    marker = key.get()
+    if marker is None:
+      return
+    age = _IdempotencyMarkerAge(marker)
+    if age >= IDEMPOTENCY_TTL:
+      _DeleteExpiredMarker(key)
+      return
+    sent = marker.sent
+    memcache.add(cache_key, sent, time=max(int(IDEMPOTENCY_TTL - age), 1))
+  return sent
+
+
+# pylint: disable=no-value-for-parameter
+@ndb.transactional
+def _DeleteExpiredMarker(key):
+  """Deletes an idempotency marker, unless a new send has just replaced it.
+
+  Args:
+    key: (ndb.Key) The marker's key.
+  """
+  marker = key.get()
+  if marker is not None and _IdempotencyMarkerAge(marker) >= IDEMPOTENCY_TTL:
+    key.delete()
+
+
+def MarkIdempotentSend(uid, action, idempotency_key, now):
+  """Records a send's idempotency key; call within the send's transaction.
+
+  Args:
+    uid: (int) The sender's object id.
+    action: (str) "message" or "rose".
+    idempotency_key: (str) The key supplied by the client.
+    now: (datetime.datetime) The send time.
+
+  Returns:
+    (model.IdempotencyMarker or None) The marker, for the caller to put, or
+    None if a send with the key has committed within the last IDEMPOTENCY_TTL
+    seconds. An older marker is simply overwritten.
+  """
+  key = IdempotencyMarkerKey(uid, action, idempotency_key)
+  marker = key.get()
+  if marker is not None and _IdempotencyMarkerAge(marker) < IDEMPOTENCY_TTL:
+    return
+  cache_key = _IdempotencyCacheKey(uid, action, idempotency_key)
+  ndb.get_context().call_on_commit(
+      lambda: memcache.set(cache_key, now, time=IDEMPOTENCY_TTL))
+  return model.IdempotencyMarker(
+      key=key, sent=now, created=datetime.datetime.today())
+
+
+def SendMessage(sender, recipient, blob, now=None, idempotency_key=None):
+  """Sends a message from one user to another.
+
+  The message reaches the recipient's relationship through their inbound
+  event log; see inbound.DeliverInbound.
+
+  Args:
+    sender: (int) The user object id of the sender.
+    recipient: (int) The user object id of the recipient.
+    blob: (str) Raw AAC file bytestring.
+    now: (datetime.datetime) To peg the current time; for testing.
+    idempotency_key: (str) Supplied by the client, so that retrying a request
+      returns the original send time instead of sending again.
+
+  Returns:
+    (datetime.datetime or None) Send time, or None if sending failed.
+  """
+  assert sender != recipient, "User {u} tried to message itself.".format(
+      u=sender)
+  if idempotency_key:
+    sent = LookupIdempotentSend(sender, "message", idempotency_key)
+    if sent is not None:
+      return sent
+  now = now or datetime.datetime.today()
+  ts = common.Milis(now)
+  rel_future = RelationshipAsync(recipient, sender)
+  partner_future = GetUserAsync(recipient)
+
+  # Save the actual audio up front, so the transaction only writes metadata
+  file_key = ndb.Key(
+      model.MessageFile, ts,
+      parent=model.Relationship(id=recipient, parent=UKey(sender)).key)
+  model.MessageFile(key=file_key, blob=blob).put()
+
+  start = time.time()
+  try:
+    event = _SendMessageTransaction(
+        sender, recipient, now, rel_future.get_result(),
+        partner_future.get_result(), idempotency_key)
+  except Exception:
+    # Even a TransactionFailedError doesn't rule out that the transaction
+    # committed, so only delete the audio once that has settled.
+    TRANSACTION_STATS["SendMessage", "failures"] += 1
+    deferred.defer(
+        CollectMessageFile, sender, recipient, ts,
+        _countdown=MESSAGE_FILE_GC_DELAY)
+    raise
+  finally:
+    TRANSACTION_STATS["SendMessage", "milliseconds"] += int(
+        (time.time() - start) * 1000)
+  TRANSACTION_STATS["SendMessage", "commits"] += 1
+  if event is None:
+    file_key.delete()
+    if idempotency_key:
+      # A concurrent retry may have sent the message first
+      return LookupIdempotentSend(sender, "message", idempotency_key)
+    return
+  inbound.DeliverInbound(event)
+  return now
+
+
+def CollectMessageFile(sender, recipient, ts):
+  """Deletes the audio of a message whose send never committed.
+
+  Args:
+    sender: (int) The user object id of the sender.
+    recipient: (int) The user object id of the recipient.
+    ts: (int) The send timestamp, in miliseconds since epoch.
+
+  Returns:
+    (bool) Whether the audio was an orphan, and so was deleted.
+  """
+  rel_key = model.Relationship(id=recipient, parent=UKey(sender)).key
+  if ndb.Key(model.SentMessage, ts, parent=rel_key).get() is not None:
+    return False
+  ndb.Key(model.MessageFile, ts, parent=rel_key).delete()
+  return True
+
+
+# pylint: disable=no-value-for-parameter
+@ndb.transactional(xg=True)
+def _SendMessageTransaction(
+    sender, recipient, now, recipient_rel, partner, idempotency_key=None):
+  """Writes the metadata for the sender's side of a message; see SendMessage.
+
+  Args:
+    sender: (int) The user object id of the sender.
+    recipient: (int) The user object id of the recipient.
+    now: (datetime.datetime) The send time.
+    recipient_rel: (model.Relationship) With recipient as agent, read outside
+      the transaction.
+    partner: (model.User) The recipient, read outside the transaction so that
+      only the sender's entity groups are enlisted.
+    idempotency_key: (str) Supplied by the client; see SendMessage.
+
+  Returns:
+    (model.InboundEvent or None) The message's inbound event, or None if the
+    message isn't allowed or was already sent with the idempotency key.
+  """
+  TRANSACTION_STATS["SendMessage", "attempts"] += 1
+  ts = common.Milis(now)
+  sender_rel = Relationship(sender, recipient)
+
+  # Check that the message is allowed.
+  if not CanMessage(sender_rel, recipient_rel):
+    return
+  dirty = []
+  if idempotency_key:
+    marker = MarkIdempotentSend(sender, "message", idempotency_key, now)
+    if marker is None:
+      return
+    dirty.append(marker)
+  CopyPartnerInfo(sender_rel, partner)
+
+  # Save a trace in the sender's relationship, and queue one for the recipient
+  sent_msg = model.SentMessage(id=ts, parent=sender_rel.key)
+  event = model.InboundEvent(
+      key=inbound.InboundEventKey(recipient, sender, "message", ts),
+      recipient=recipient, sender=sender, kind="message", sent=now)
+
+  # Update the last sent message field in the sender's relationship
+  sender_rel.last_sent_message = max(sender_rel.last_sent_message, now)
+  sender_rel.last_updated = max(sender_rel.last_updated, now)
+  AddRecentEvent(sender_rel, "message", True, ts)
+  ndb.put_multi([sent_msg, sender_rel, event] + dirty)
+  cache.TouchInbox(sender)
+
+  return event
+
+
+def MigrateRetrievals(msg):
+  """Folds a message's legacy list of retrieval times into its counters.
+
+  Only changes the entity in memory; the caller decides whether to put it.
+
+  Args:
+    msg: (model.Message) A SentMessage or ReceivedMessage.
+
+  Returns:
+    (bool) Whether the message had a legacy list.
+  """
+  # pylint: disable=protected-access
+  prop = msg._properties.get("retrieved")
+  if prop is None:
+    return False
+  retrieved = prop._get_value(msg) or []
+  if not isinstance(retrieved, list):
+    retrieved = [retrieved]
+  if retrieved:
+    msg.first_retrieved = min(retrieved)
+    msg.last_retrieved = max(retrieved)
+    msg.retrieval_count = len(retrieved)
+  del msg._properties["retrieved"]
+  msg._values.pop("retrieved", None)
+  return True
+
+
+def MigrateMessages(message_class, cursor=None, batch_size=100):
+  """Migrates one batch of messages with legacy retrieval lists.
+
+  Call repeatedly for both model.SentMessage and model.ReceivedMessage,
+  passing in the returned cursor, until it returns None.
+
+  Args:
+    message_class: (class) model.SentMessage or model.ReceivedMessage.
+    cursor: (ndb.Cursor) Where the previous batch left off.
+    batch_size: (int) The number of messages to scan.
+
+  Returns:
+    (ndb.Cursor or None) Where to resume, or None if there's nothing left.
+  """
+  msgs, next_cursor, more = message_class.query().fetch_page(
+      batch_size, start_cursor=cursor)
+  migrated = [msg for msg in msgs if MigrateRetrievals(msg)]
+  if migrated:
+    ndb.put_multi(migrated)
+    cache.Invalidate(*[msg.key for msg in migrated])
+  return next_cursor if more else None
+
+
+def RecordRetrieval(sender, recipient, send_time, now):
+  """Marks a message as listened to; deferred by GetMessageFile.
+
+  Replaying a retrieval that has already been recorded changes nothing, nor
+  does a retrieval that runs after a later one has been recorded.
+
+  Args:
+    sender: (int) The user object id of the sender.
+    recipient: (int) The user object id of the recipient.
+    send_time: (int or datetime.datetime) The message timestamp.
+    now: (datetime.datetime) The retrieval time.
+  """
+  if isinstance(send_time, datetime.datetime):
+    send_time = common.Milis(send_time)
+  if not _RecordRetrievalAsync(sender, recipient, send_time, now).get_result():
+    # Listening to a message the recipient's log has yet to fold
+    inbound.FoldInbound(recipient, [
+        inbound.InboundEventKey(recipient, sender, "message", send_time)])
+    _RecordRetrievalAsync(sender, recipient, send_time, now).get_result()
+
+
+# pylint: disable=no-value-for-parameter
+@ndb.transactional_tasklet(xg=True)
+def _RecordRetrievalAsync(sender, recipient, send_time, now):
+  """Asynchronously marks a message as listened to; see RecordRetrieval.
+
+  Args:
+    sender: (int) The user object id of the sender.
+    recipient: (int) The user object id of the recipient.
+    send_time: (int) The message timestamp.
+    now: (datetime.datetime) The retrieval time.
+
+  Returns:
+    (ndb.Future) Resolves to False if the message has yet to be folded into
+    the recipient's relationship, else True.
+  """
+  sent_key = ndb.Key(
+      model.SentMessage, send_time,
+      parent=model.Relationship(id=recipient, parent=UKey(sender)).key)
+  rcvd_key = ndb.Key(
+      model.ReceivedMessage, send_time,
+      parent=model.Relationship(id=sender, parent=UKey(recipient)).key)
+  sent_msg, rcvd_msg, sender_rel, recipient_rel = yield (
+      sent_key.get_async(),
+      rcvd_key.get_async(),
+      RelationshipAsync(sender, recipient),
+      RelationshipAsync(recipient, sender))
+  if rcvd_msg is None:
+    raise ndb.Return(False)
+  Guarantee(sent_msg)
+  for msg in (sent_msg, rcvd_msg):
+    MigrateRetrievals(msg)
+  if rcvd_msg.last_retrieved and now <= rcvd_msg.last_retrieved:
+    # A retry of a retrieval that has already been recorded, or one that ran
+    # late, after a later retrieval
+    raise ndb.Return(True)
+  dirty = [sent_msg, rcvd_msg]
+  if rcvd_msg.new:
+    totals = yield GetUnreadTotalsAsync(recipient)
+    recipient_rel.new_messages -= 1
+    totals.new_messages -= 1
+    recipient_rel.last_updated = max(recipient_rel.last_updated, now)
+    MarkRecentEventRead(recipient_rel, "message", rcvd_msg.key.id())
+    dirty.extend([recipient_rel, totals])
+    cache.TouchInbox(recipient)
+    cache.Invalidate(totals.key)
+  if MarkRecentEventRead(sender_rel, "message", sent_msg.key.id()):
+    sender_rel.last_updated = max(sender_rel.last_updated, now)
+    dirty.append(sender_rel)
+    cache.TouchInbox(sender)
+  for msg in (sent_msg, rcvd_msg):
+    msg.new = False
+    msg.first_retrieved = min(msg.first_retrieved or now, now)
+    msg.last_retrieved = max(msg.last_retrieved or now, now)
+    msg.retrieval_count += 1
+  yield ndb.put_multi_async(dirty)
+  cache.Invalidate(sent_msg.key, rcvd_msg.key)
+
+  raise ndb.Return(True)
+
+
+@ndb.tasklet
+def GetMessageFileAsync(sender, recipient, send_time, record_retrieval,
+                        now=None):
+  """Asynchronously retrieves the audio of a message; see GetMessageFile.
+
+  Args:
+    sender: (int) The user object id of the sender.
+    recipient: (int) The user object id of the recipient.
+    send_time: (int or datetime.datetime) The message timestamp.
+    record_retrieval: (bool) If true, unmark the message as new and record
+      when it was retrieved, in a deferred task.
+    now: (datetime.datetime) To peg the current time; for testing.
+
+  Returns:
+    (ndb.Future) Resolves to the raw aac file bytestring.
+  """
+  now = now or datetime.datetime.today()
+  message_file = yield GetForRelationshipAsync(
+      model.MessageFile, sender, recipient, send_time)
+  if record_retrieval:
+    deferred.defer(RecordRetrieval, sender, recipient, send_time, now)
+  raise ndb.Return(message_file.blob)
+
+
+def GetMessageFile(sender, recipient, send_time, record_retrieval, now=None):
+  """Retrieves the audio of a message.
+
+  The audio is returned after a plain read; recording the retrieval happens
+  afterwards, in a deferred task, so it never delays playback.
+
+  Args:
+    sender: (int) The user object id of the sender.
+    recipient: (int) The user object id of the recipient.
+    send_time: (int or datetime.datetime) The message timestamp.
+    record_retrieval: (bool) If true, unmark the message as new and record
+      when it was retrieved.
+    now: (datetime.datetime) To peg the current time; for testing.
+
+  Returns:
+    (str) Raw aac file bytestring.
+  """
+  return GetMessageFileAsync(
+      sender, recipient, send_time, record_retrieval, now=now).get_result()
+
+
+# Messages per page of Thread, by default and at most.
+THREAD_PAGE_SIZE = 20
+THREAD_MAX_PAGE_SIZE = 100
+
+
+def Thread(uid, partner, before_ms=None, limit=THREAD_PAGE_SIZE):
+  """Lists the messages exchanged between two users, most recent first.
+
+  Only message metadata is read; audio has to be fetched with GetMessageFile.
+  Messages still in uid's inbound log are included.
+
+  Args:
+    uid: (int) The user object id of the user viewing the conversation.
+    partner: (int) The user object id of the other user.
+    before_ms: (int) Only list messages sent before this timestamp, in
+      miliseconds since epoch; pass the previous page's next_before_ms.
+    limit: (int) The maximum number of messages to return, up to
+      THREAD_MAX_PAGE_SIZE. A page may hold one more, so that a sent and a
+      received message with the same timestamp are never split across pages.
+
+  Returns:
+    (list of dict, int or None) The messages' send_timestamp_ms, whether uid
+    sent them, new flags and retrieval counts, and the before_ms for the next
+    page, or None if there are no more messages.
+  """
+  limit = max(1, min(limit, THREAD_MAX_PAGE_SIZE))
+  rel_key = model.Relationship(id=partner, parent=UKey(uid)).key
+  futures = []
+  for model_class in (model.SentMessage, model.ReceivedMessage):
+    query = model_class.query(ancestor=rel_key)
+    if before_ms is not None:
+      query = query.filter(
+          model_class.key < ndb.Key(model_class, before_ms, parent=rel_key))
+    # Enough to fill a page that takes an extra message; see below.
+    futures.append(query.order(-model_class.key).fetch_async(limit + 2))
+  pending_future = model.InboundEvent.query(
+      ancestor=inbound.InboundLogKey(uid, partner)).fetch_async()
+
+  # Messages from the partner that have yet to be folded count as received.
+  msgs = {}
+  for event in pending_future.get_result():
+    ts = common.Milis(event.sent)
+    if (event.sender == partner and event.kind == "message" and
+        (before_ms is None or ts < before_ms)):
+      msgs[False, ts] = {
+          "send_timestamp_ms": ts, "sent": False, "new": True,
+          "retrieval_count": 0}
+  for future in futures:
+    for msg in future.get_result():
+      MigrateRetrievals(msg)
+      sent = isinstance(msg, model.SentMessage)
+      msgs[sent, msg.key.id()] = {
+          "send_timestamp_ms": msg.key.id(),
+          "sent": sent,
+          "new": msg.new,
+          "retrieval_count": msg.retrieval_count}
+  thread = sorted(
+      msgs.itervalues(), key=lambda msg: msg["send_timestamp_ms"],
+      reverse=True)
+  next_before_ms = None
+  # The next page starts strictly before this one's last message, so a sent
+  # and a received message sharing that timestamp have to stay together.
+  if (len(thread) > limit and thread[limit]["send_timestamp_ms"] ==
+      thread[limit - 1]["send_timestamp_ms"]):
+    limit += 1
+  if len(thread) > limit:
+    thread = thread[:limit]
+    next_before_ms = thread[-1]["send_timestamp_ms"]
+  return thread, next_before_ms
+
+
+# --------------------------------------------------------------------------- #
+# Working with the garden.                                                    #
+# --------------------------------------------------------------------------- #
+
+def RandomGrowingPeriod():
+  """Random growing time that averages one day.
+
+  Returns:
+    (datetime.timedelta) Time required for a new rose to grow!
+  """
+  hours = random.choice([
+      random.expovariate(1) + 1,   # Just a few hours
+      random.gauss(22.75, 1.5),   # About one day
+      random.gauss(46.75, 1.5)])  # About two days
+  return datetime.timedelta(hours=hours)
 
 
-def GetIntro(uid):
-  """Gets a user's audio intro.
+def GardenKey(uid):
+  """Returns the key for the model.Garden object of the given user.
 
   Args:
     uid: (int) The user's object id.
 
   Returns:
-    (str) Raw AAC file bytestring
+    (ndb.Key) The garden key.
   """
-  return GetForUid(model.IntroFile, uid).blob
+  return ndb.Key(model.Garden, 1, parent=UKey(uid))
 
 
-def SetImage(uid, blob):
-  """Sets a user's chat image.
+def GrowingRoses(garden):
+  """Views the roses packed into a garden as model.Rose objects.
+
+  The returned roses are keyed 1, 2, and 3 under the garden, as they were when
+  roses were stored as separate entities, but are never written themselves;
+  update garden.roses and put the garden instead.
 
   Args:
-    uid: (int) The user's object id.
-    blob: (unicode) Raw png file bytestring.
+    garden: (model.Garden) The garden.
+
+  Returns:
+    (list of model.Rose) The roses.
   """
-  blob = str(blob)
-  #TODO validate file format and size, and image dimensions
-  user_key = UKey(uid)
-  image = model.ImageFile(id=1, parent=user_key, blob=blob)
-  image.put()
+  return [
+      model.Rose(
+          id=number, parent=garden.key,
+          bloomed=rose.bloomed, planted=rose.planted)
+      for number, rose in enumerate(garden.roses, 1)]
 
 
-def GetImage(uid):
-  """Gets a user's chat image.
+# pylint: disable=no-value-for-parameter
+@ndb.transactional_tasklet
+def MigrateGardenAsync(uid):
+  """Packs a garden's stand-alone legacy model.Rose entities into the Garden.
+
+  Does nothing for gardens that have already been migrated.
 
   Args:
     uid: (int) The user's object id.
 
   Returns:
-    (str) Raw png file bytestring
+    (ndb.Future) Resolves to the migrated model.Garden.
   """
-  return GetForUid(model.ImageFile, uid).blob
+  garden_key = GardenKey(uid)
+  garden = yield garden_key.get_async()
+  if garden is not None and garden.roses:
+    raise ndb.Return(garden)
+  legacy_keys = [ndb.Key(model.Rose, i, parent=garden_key) for i in (1, 2, 3)]
+  legacy_roses = yield ndb.get_multi_async(legacy_keys)
+  garden = model.Garden(key=garden_key, roses=[
+      model.Rose(bloomed=Guarantee(rose).bloomed, planted=rose.planted)
+      for rose in legacy_roses])
+  yield garden.put_async(), ndb.delete_multi_async(legacy_keys)
+  raise ndb.Return(garden)
 
 
-# --------------------------------------------------------------------------- #
-# Working with messages.                                                      #
-# --------------------------------------------------------------------------- #
+def MigrateGardens(cursor=None, batch_size=100):
+  """Migrates one batch of legacy gardens; see MigrateGardenAsync.
 
-def CanMessage(sender_rel, recipient_rel):
-  """Determines whether one user is allowed to message another.
+  Call repeatedly, passing in the returned cursor, until it returns None.
 
   Args:
-    sender_rel: (model.Relationship) With sender as agent.
-    recipient_rel: (model.Relationship) With recipient as agent.
+    cursor: (ndb.Cursor) Where the previous batch left off.
+    batch_size: (int) The number of legacy roses to scan.
 
   Returns:
-    (bool) True if the sender is allowed to message the recipient.
+    (ndb.Cursor or None) Where to resume, or None if there's nothing left.
   """
-  #TODO
-  return True
+  keys, next_cursor, more = model.Rose.query().fetch_page(
+      batch_size, start_cursor=cursor, keys_only=True)
+  uids = set(key.parent().parent().id() for key in keys)
+  for future in [MigrateGardenAsync(uid) for uid in uids]:
+    future.get_result()
+  return next_cursor if more else None
 
 
-# pylint: disable=no-value-for-parameter
-@ndb.transactional(xg=True)
-def SendMessage(sender, recipient, blob, now=None):
-  """Sends a message from one user to another.
+@ndb.tasklet
+def LoadGardenAsync(uid):
+  """Asynchronously loads a user's garden, migrating it if needed.
 
   Args:
-    sender: (int) The user object id of the sender.
-    recipient: (int) The user object id of the recipient.
-    blob: (str) Raw AAC file bytestring.
-    now: (datetime.datetime) To peg the current time; for testing.
+    uid: (int) The user object id.
 
   Returns:
-    (datetime.datetime or None) Send time, or None if sending failed.
+    (ndb.Future) Resolves to the model.Garden.
   """
-  assert sender != recipient, "User {u} tried to message itself.".format(
-      u=sender)
-  now = now or datetime.datetime.today()
-  ts = common.Milis(now)
-  sender_rel, recipient_rel = Relationships(sender, recipient, full=True)
-
-  # Check that the message is allowed.
-  if not CanMessage(sender_rel, recipient_rel):
-    return
+  garden = yield GardenKey(uid).get_async()
+  if garden is None or not garden.roses:
+    garden = yield MigrateGardenAsync(uid)
+  raise ndb.Return(garden)
 
-  # Save the actual audio
-  model.MessageFile(id=ts, parent=sender_rel.key, blob=blob).put()
 
-  # Save a trace in both the sender and recipients' relationships
-  model.SentMessage(id=ts, parent=sender_rel.key).put()
-  model.ReceivedMessage(id=ts, parent=recipient_rel.key).put()
-
-  # Update the last sent and last received message fields in the relationships
-  sender_rel.last_sent_message = max(sender_rel.last_sent_message, now)
-  sender_rel.put()
-  recipient_rel.last_received_message = max(
-      recipient_rel.last_received_message, now)
-  recipient_rel.last_incoming = max(recipient_rel.last_incoming, now)
-  recipient_rel.new_messages += 1
-  recipient_rel.put()
-
-  return now
-
-
-# pylint: disable=no-value-for-parameter
-@ndb.transactional(xg=True)
-def GetMessageFile(sender, recipient, send_time, record_retrieval, now=None):
-  """Retrieves the audio of a message.
+def LoadGarden(uid):
+  """Loads a user's garden, with its three growing roses.
 
   Args:
-    sender: (int) The user object id of the sender.
-    recipient: (int) The user object id of the recipient.
-    send_time: (int or datetime.datetime) The message timestamp.
-    record_retrieval: (bool) If true, unmark the message as new and record
-      when it was retrieved.
-    now: (datetime.datetime) To peg the current time; for testing.
+    uid: (int) The user object id.
 
   Returns:
-    (str) Raw aac file bytestring.
+    (model.Garden) The garden.
   """
-  now = now or datetime.datetime.today()
-  blob = GetForRelationship(
-      model.MessageFile, sender, recipient, send_time).blob
-
-  # Record the tretrieval
-  if record_retrieval:
-    sent_msg = GetForRelationship(
-        model.SentMessage, sender, recipient, send_time)
-    rcvd_msg = GetForRelationship(
-        model.ReceivedMessage, recipient, sender, send_time)
-    if rcvd_msg.new:
-      recipient_rel = Relationship(recipient, sender)
-      recipient_rel.new_messages -= 1
-      recipient_rel.put()
-    for msg in (sent_msg, rcvd_msg):
-      msg.new = False
-      msg.retrieved.append(now)
-      msg.put()
-
-  return blob
+  return LoadGardenAsync(uid).get_result()
 
 
-# --------------------------------------------------------------------------- #
-# Working with the garden.                                                    #
-# --------------------------------------------------------------------------- #
+@ndb.tasklet
+def GetGrowingRoseAsync(uid, rose_number):
+  """Asynchronously gets the given growing rose.
 
-def RandomGrowingPeriod():
-  """Random growing time that averages one day.
+  Args:
+    uid: (int) The user object id of the user to fetch a rose for.
+    rose_number: (int) The id of the rose to get; 1, 2, or 3.
 
   Returns:
-    (datetime.timedelta) Time required for a new rose to grow!
+    (ndb.Future) Resolves to the model.Rose.
   """
-  hours = random.choice([
-      random.expovariate(1) + 1,   # Just a few hours
-      random.gauss(22.75, 1.5),   # About one day
-      random.gauss(46.75, 1.5)])  # About two days
-  return datetime.timedelta(hours=hours)
+  assert rose_number in (1, 2, 3), "Rose number must be 1, 2, or 3."
+  roses = yield GetGardenAsync(uid)
+  raise ndb.Return(roses[rose_number - 1])
 
 
 def GetGrowingRose(uid, rose_number):
@@ -434,9 +1470,21 @@ def GetGrowingRose(uid, rose_number):
   Returns:
     (model.Rose) The rose.
   """
-  assert rose_number in (1, 2, 3), "Rose number must be 1, 2, or 3."
-  return Guarantee(model.Rose.get_by_id(
-      id=rose_number, parent=model.Garden(id=1, parent=UKey(uid)).key))
+  return GetGrowingRoseAsync(uid, rose_number).get_result()
+
+
+@ndb.tasklet
+def GetGardenAsync(uid):
+  """Asynchronously fetches all of a user's growing roses.
+
+  Args:
+    uid: (int) The user object id.
+
+  Returns:
+    (ndb.Future) Resolves to the list of three model.Rose.
+  """
+  garden = yield LoadGardenAsync(uid)
+  raise ndb.Return(GrowingRoses(garden))
 
 
 def GetGarden(uid):
@@ -448,60 +1496,105 @@ def GetGarden(uid):
   Returns:
     (triple of model.Rose) The roses.
   """
-  return [GetGrowingRose(uid, i) for i in (1, 2, 3)]
-
+  return GetGardenAsync(uid).get_result()
 
 
-@ndb.transactional(xg=True)
-def SendRose(sender, recipient, rose_number, now=None):
+def SendRose(sender, recipient, rose_number, now=None, idempotency_key=None):
   """Sends a rose from the sender to the recipient, if possible.
 
+  The rose reaches the recipient's relationship through their inbound event
+  log; see inbound.DeliverInbound.
+
   Args:
     sender: (int) The user object id of the sender.
     recipient: (int) The user object id of the recipient.
     rose_number: (int) The id of the rose to send.
     now: (datetime.datetime) To peg the current time; for testing.
+    idempotency_key: (str) Supplied by the client, so that retrying a request
+      returns the original send time instead of sending again.
 
   Returns:
     (datetime.datetime or None) Send time, or None if sending failed.
   """
   assert sender != recipient, "User {u} tried to send itself a rose.".format(
       u=sender)
+  assert rose_number in (1, 2, 3), "Rose number must be 1, 2, or 3."
+  if idempotency_key:
+    sent = LookupIdempotentSend(sender, "rose", idempotency_key)
+    if sent is not None:
+      return sent
   now = now or datetime.datetime.today()
-  growing_rose = GetGrowingRose(sender, rose_number)
+  event = _SendRoseTransaction(
+      sender, recipient, rose_number, now, GetUser(recipient), idempotency_key)
+  if event is None:
+    if idempotency_key:
+      # A concurrent retry may have sent the rose first
+      return LookupIdempotentSend(sender, "rose", idempotency_key)
+    return
+  inbound.DeliverInbound(event)
+  return now
+
+
+# pylint: disable=no-value-for-parameter
+@ndb.transactional(xg=True)
+def _SendRoseTransaction(
+    sender, recipient, rose_number, now, partner, idempotency_key=None):
+  """Writes the sender's side of a rose; see SendRose.
+
+  Args:
+    sender: (int) The user object id of the sender.
+    recipient: (int) The user object id of the recipient.
+    rose_number: (int) The id of the rose to send.
+    now: (datetime.datetime) The send time.
+    partner: (model.User) The recipient, read outside the transaction; see
+      _SendMessageTransaction.
+    idempotency_key: (str) Supplied by the client; see SendRose.
+
+  Returns:
+    (model.InboundEvent or None) The rose's inbound event, or None if the rose
+    has yet to bloom or was already sent with the idempotency key.
+  """
+  garden = LoadGarden(sender)
+  growing_rose = garden.roses[rose_number - 1]
 
   # Sending fails if the rose has yet to bloom.
   if growing_rose.bloomed > now:
     return
-
-  # Save a trace in both the sender and recipients' relationships
+  dirty = [garden]
+  if idempotency_key:
+    marker = MarkIdempotentSend(sender, "rose", idempotency_key, now)
+    if marker is None:
+      return
+    dirty.append(marker)
+
+  # Save a trace in the sender's relationship, and queue one for the recipient
   ts = common.Milis(now)
-  sender_rel, recipient_rel = Relationships(sender, recipient, full=True)
-  rose_kwargs = {
-      "id": ts,
-      "bloomed": growing_rose.bloomed,
-      "planted": growing_rose.planted}
-  model.SentRose(parent=sender_rel.key, **rose_kwargs).put()
-  model.ReceivedRose(parent=recipient_rel.key, **rose_kwargs).put()
-
-  # Update the last sent and last received rose fields in the relationships
+  sender_rel = Relationship(sender, recipient)
+  CopyPartnerInfo(sender_rel, partner)
+  model.SentRose(
+      id=ts, parent=sender_rel.key,
+      bloomed=growing_rose.bloomed, planted=growing_rose.planted).put()
+  event = model.InboundEvent(
+      key=inbound.InboundEventKey(recipient, sender, "rose", ts),
+      recipient=recipient, sender=sender, kind="rose", sent=now,
+      bloomed=growing_rose.bloomed, planted=growing_rose.planted)
+
+  # Update the last sent rose field in the sender's relationship
   sender_rel.last_sent_rose = max(sender_rel.last_sent_rose, now)
-  sender_rel.put()
-  recipient_rel.last_received_rose = max(recipient_rel.last_received_rose, now)
-  recipient_rel.last_incoming = max(recipient_rel.last_incoming, now)
-  recipient_rel.new_roses += 1
-  recipient_rel.put()
+  sender_rel.last_updated = max(sender_rel.last_updated, now)
+  AddRecentEvent(sender_rel, "rose", True, ts)
+  cache.TouchInbox(sender)
 
   # Plant a new rose, to bloom on average one day later
-  growing_rose.planeted = now
+  growing_rose.planted = now
   growing_rose.bloomed = now + RandomGrowingPeriod()
-  growing_rose.put()
+  ndb.put_multi([sender_rel, event] + dirty)
 
-  return now
+  return event
 
 
 @ndb.transactional(xg=True)
-def Water(uid, kind, roses=None, **kwargs):
+def Water(uid, kind, garden=None, **kwargs):
   """Bloom the rose with the longest remaining time to bloom.
 
   You can't water a rose that's scheduled to bloom within 10 minutes, or a rose
@@ -510,29 +1603,29 @@ def Water(uid, kind, roses=None, **kwargs):
   Args:
     uid: (int) The user's object id
     kind: (int) 0 for paid, 1 for invite, 2 for lotto, ...
-    roses: (triple of model.Rose) The user's garden.
+    garden: (model.Garden) The user's garden.
     kwargs: (dict) Additional properties of the watering event.
 
   Returns:
     (int) The id of the bloomed rose, or None if no rose could be bloomed.
   """
-  roses = roses or GetGarden(uid)
+  garden = garden or LoadGarden(uid)
   now = datetime.datetime.today()
-  greenest = max(roses, key=lambda rose: rose.bloomed)
+  number, greenest = max(
+      enumerate(garden.roses, 1), key=lambda pair: pair[1].bloomed)
   if greenest.bloomed - now < datetime.timedelta(minutes=10):
     return None
 
   # Update bloom time and record watering event
   greenest.bloomed = now
-  greenest.put()
   watering = model.Watering(
-      parent=model.Garden(id=1, parent=UKey(uid)).key,
+      parent=garden.key,
       timestamp=now,
       kind=kind,
       **kwargs)
-  watering.put()
+  ndb.put_multi([garden, watering])
 
-  return greenest.key.id()
+  return number
 
 
 def EligibleForWatering(uid, roses=None):
@@ -569,15 +1662,283 @@ def MaybeWaterForLotto():
   raise NotImplementedError
 
 
+# --------------------------------------------------------------------------- #
+# Profile visits.                                                             #
+# --------------------------------------------------------------------------- #
+
+# The number of visitors kept in each user's model.RecentVisitors.
+RECENT_VISITORS_CAP = 50
+
+
+def AddRecentVisit(recent, visitor, timestamp):
+  """Adds a visit to a model.RecentVisitors, keeping it capped and sorted.
+
+  Args:
+    recent: (model.RecentVisitors) The visited user's recent visitors.
+    visitor: (int) The user object id of the visitor.
+    timestamp: (datetime.datetime) When the visit happened.
+  """
+  visits = [visit for visit in recent.visits if visit.uid != visitor]
+  timestamp = max([timestamp] + [
+      visit.timestamp for visit in recent.visits if visit.uid == visitor])
+  visits.append(model.Visit(uid=visitor, timestamp=timestamp))
+  visits.sort(key=lambda visit: visit.timestamp, reverse=True)
+  recent.visits = visits[:RECENT_VISITORS_CAP]
+
+
+# The pull queue buffering visits until they're flushed; see QueueVisit.
+VISITS_QUEUE = "visits"
+
+# Seconds between flushes of the visits queue.
+VISIT_FLUSH_INTERVAL = 5
+
+# The most buffered visits leased by one flush, and for how many seconds.
+VISIT_BATCH_SIZE = 500
+VISIT_LEASE_SECONDS = 60
+
+
+def RecordVisit(visitor, visited, now=None):
+  """Records that one user viewed another's profile, right away.
+
+  Args:
+    visitor: (int) The user object id of the viewer.
+    visited: (int) The user object id of the user whose profile was viewed.
+    now: (datetime.datetime) To peg the current time; for testing.
+  """
+  ApplyVisits({(visitor, visited): now or datetime.datetime.today()})
+
+
+def QueueVisit(visitor, visited, now=None):
+  """Records that one user viewed another's profile, in the background.
+
+  The visit is buffered in the visits pull queue, and written by the next
+  FlushVisits along with any others, so browsing never waits on writes to
+  relationships.
+
+  Args:
+    visitor: (int) The user object id of the viewer.
+    visited: (int) The user object id of the user whose profile was viewed.
+    now: (datetime.datetime) To peg the current time; for testing.
+  """
+  now = now or datetime.datetime.today()
+  taskqueue.Queue(VISITS_QUEUE).add(taskqueue.Task(
+      payload=json.dumps([visitor, visited, common.Milis(now)]),
+      method="PULL"))
+  DeferOncePerInterval(VISIT_FLUSH_INTERVAL, "flush-visits", FlushVisits)
+
+
+def FlushVisits():
+  """Writes a batch of buffered visits, chaining another flush if more remain.
+
+  Only the latest visit between each pair of users is written.
+
+  Returns:
+    (int) The number of pairs of users whose visits were written.
+  """
+  queue = taskqueue.Queue(VISITS_QUEUE)
+  tasks = queue.lease_tasks(VISIT_LEASE_SECONDS, VISIT_BATCH_SIZE)
+  if not tasks:
+    return 0
+  latest = {}
+  for task in tasks:
+    visitor, visited, ms = json.loads(task.payload)
+    latest[visitor, visited] = max(latest.get((visitor, visited), ms), ms)
+  ApplyVisits(dict(
+      (pair, common.FromMilis(ms)) for pair, ms in latest.iteritems()))
+  queue.delete_tasks(tasks)
+  if len(tasks) == VISIT_BATCH_SIZE:
+    deferred.defer(FlushVisits)
+  return len(latest)
+
+
+def ApplyVisits(visits):
+  """Writes profile visits to both users' relationships.
+
+  Each user's relationships and recent visitors are written by one
+  transaction, and the transactions run in parallel. Visits only ever move
+  timestamps forward, so replaying them is harmless.
+
+  Args:
+    visits: (dict) Mapping (visitor, visited) user object id pairs to when
+      the visit happened.
+  """
+  by_user = collections.defaultdict(list)
+  for (visitor, visited), when in visits.iteritems():
+    by_user[visitor].append((visitor, visited, when))
+    by_user[visited].append((visitor, visited, when))
+  futures = [
+      _ApplyUserVisitsAsync(uid, user_visits)
+      for uid, user_visits in by_user.iteritems()]
+  for future in futures:
+    future.get_result()
+
+
+# pylint: disable=no-value-for-parameter
+@ndb.transactional_tasklet
+def _ApplyUserVisitsAsync(uid, visits):
+  """Asynchronously writes one user's side of some visits; see ApplyVisits.
+
+  Args:
+    uid: (int) The user's object id.
+    visits: (list of tuple) The (visitor, visited, when) of each visit that
+      uid is party to.
+
+  Returns:
+    (ndb.Future) Resolves once the visits are written.
+  """
+  partners = sorted(set(
+      visited if visitor == uid else visitor
+      for visitor, visited, _ in visits))
+  rels = yield [RelationshipAsync(uid, partner, full=False)
+                for partner in partners]
+  rels = dict(zip(partners, rels))
+  dirty = rels.values()
+  if any(visited == uid for _, visited, _ in visits):
+    recent_key = ndb.Key(model.RecentVisitors, 1, parent=UKey(uid))
+    recent = yield recent_key.get_async()
+    recent = recent or model.RecentVisitors(key=recent_key)
+    dirty.append(recent)
+  for visitor, visited, when in visits:
+    if visitor == uid:
+      rel = rels[visited]
+      rel.last_visited = max(rel.last_visited or model.NEVER, when)
+    else:
+      rel = rels[visitor]
+      rel.last_visited_by = max(rel.last_visited_by or model.NEVER, when)
+      AddRecentVisit(recent, visitor, when)
+  yield ndb.put_multi_async(dirty)
+  cache.TouchInbox(uid)
+
+
+def GetRecentVisitors(uid):
+  """Lists the most recent visitors to a user's profile.
+
+  Args:
+    uid: (int) The user's object id.
+
+  Returns:
+    (list of dict) The visitors' uids and visit timestamps, most recent first.
+  """
+  recent = model.RecentVisitors.get_by_id(1, parent=UKey(uid))
+  if recent is None:
+    return []
+  return [visit.to_dict() for visit in recent.visits]
+
+
 # --------------------------------------------------------------------------- #
 # Get a user's interaction history / "inbox".                                 #
 # --------------------------------------------------------------------------- #
 
-def History(uid, offset=0, limit=10, cache_time=None, ascending=False,
+@ndb.tasklet
+def GetUnreadTotalsAsync(uid):
+  """Asynchronously retrieves the total unread roses and messages for a user.
+
+  Reads through the memcache entity cache; see storage.cache. Accounts created
+  before the totals were kept have them summed from their relationships and
+  saved on first read; inside a transaction, they're left for the caller to
+  save.
+
+  Args:
+    uid: (int) The user's object id.
+
+  Returns:
+    (ndb.Future) Resolves to the user's model.UnreadTotals.
+  """
+  key = ndb.Key(model.UnreadTotals, 1, parent=UKey(uid))
+  totals = yield cache.GetAsync(key)
+  if totals is None:
+    if ndb.in_transaction():
+      totals = yield _SumUnreadTotalsAsync(key)
+    else:
+      totals = yield _SeedUnreadTotalsAsync(key)
+  raise ndb.Return(totals)
+
+
+@ndb.tasklet
+def _SumUnreadTotalsAsync(key):
+  """Asynchronously sums a user's unread counts over their relationships.
+
+  Args:
+    key: (ndb.Key) The key of the user's model.UnreadTotals.
+
+  Returns:
+    (ndb.Future) Resolves to an unsaved model.UnreadTotals.
+  """
+  # Not filtered on has_new, which older relationships have no index rows for
+  rels = yield model.FullRelationship.query(
+      ancestor=key.parent()).fetch_async()
+  raise ndb.Return(model.UnreadTotals(
+      key=key,
+      new_roses=sum(rel.new_roses for rel in rels),
+      new_messages=sum(rel.new_messages for rel in rels)))
+
+
+# pylint: disable=no-value-for-parameter
+@ndb.transactional_tasklet
+def _SeedUnreadTotalsAsync(key):
+  """Asynchronously saves the summed totals of a user who has none.
+
+  Args:
+    key: (ndb.Key) The key of the user's model.UnreadTotals.
+
+  Returns:
+    (ndb.Future) Resolves to the user's model.UnreadTotals.
+  """
+  totals = yield key.get_async()
+  if totals is None:
+    totals = yield _SumUnreadTotalsAsync(key)
+    yield totals.put_async()
+  raise ndb.Return(totals)
+
+
+def GetUnreadTotals(uid):
+  """Retrieves the total unread roses and messages for a user.
+
+  Args:
+    uid: (int) The user's object id.
+
+  Returns:
+    (model.UnreadTotals) The user's totals.
+  """
+  return GetUnreadTotalsAsync(uid).get_result()
+
+
+@ndb.tasklet
+def GetBadgeAsync(uid):
+  """Asynchronously counts a user's unread roses and messages; see GetBadge.
+
+  Args:
+    uid: (int) The user's object id.
+
+  Returns:
+    (ndb.Future) Resolves to a dict of new_roses and new_messages.
+  """
+  # These memcache lookups are batched together by ndb.
+  totals, pending = yield (
+      GetUnreadTotalsAsync(uid), inbound.GetPendingAsync(uid))
+  raise ndb.Return(dict(
+      (prop, getattr(totals, prop) + count)
+      for prop, count in pending.iteritems()))
+
+
+def GetBadge(uid):
+  """Counts a user's unread roses and messages, including unfolded ones.
+
+  Args:
+    uid: (int) The user's object id.
+
+  Returns:
+    (dict) The new_roses and new_messages totals.
+  """
+  return GetBadgeAsync(uid).get_result()
+
+
+def History(uid, offset=0, limit=10, cursor=None, cache_time=None,
+            ascending=False,
             new=False, saved_only=False, blocked_only=False,
             sent_rose_only=False, received_rose_only=False,
             sent_message_only=False, received_message_only=False,
-            visited_only=False, visited_by_only=False):
+            visited_only=False, visited_by_only=False, light=False):
   """Retrieves a summary of recent interactions for a user.
 
   Default sort order is descending by last incoming communication. When the
@@ -588,12 +1949,21 @@ def History(uid, offset=0, limit=10, cache_time=None, ascending=False,
 
   Only one of the *_only args should be set.
 
+  Results are cached until something in the user's inbox changes; see
+  cache.TouchInbox.
+
+  Page through results by passing the returned cursor back in. Skipping ahead
+  with offset still works, but is deprecated: the datastore reads and bills
+  every skipped entry.
+
   Args:
     uid: (int) The user's object id.
-    offset: (int) Start at the offset'th most recent interaction.
+    offset: (int) Deprecated; start at the offset'th most recent interaction.
     limit: (int) Retrieve the n most recent interactions.
+    cursor: (str) Resume from where a previous call left off.
     cache_time: (datetime.datetime) Retrieve only interactions with profiles
-      that have been updated since this time.
+      that have been updated since this time. Results are then sorted by
+      update time instead.
     ascending: (bool) If true, sort in ascending order of date.
     new: (bool) Retrieve only interactions with profiles that have sent new
       unlistened messages or new roses.
@@ -612,10 +1982,34 @@ def History(uid, offset=0, limit=10, cache_time=None, ascending=False,
       user has visited.
     visited_by_only: (bool) Retrieve only interactions with profiles that
       have visited the user.
+    light: (bool) If true, run a cheaper projection query, and return only
+      each partner's uid, the sort timestamp, and the unread counts.
 
   Returns:
-    (list of dict) "Inbox" entries.
+    (list of dict, str or None) "Inbox" entries, and the cursor for the next
+    page, or None if this is the last page.
   """
+  args = (
+      offset, limit, cursor, cache_time, ascending, new, saved_only,
+      blocked_only, sent_rose_only, received_rose_only, sent_message_only,
+      received_message_only, visited_only, visited_by_only, light)
+  cache_key = cache.HistoryKey(uid, args)
+  result = memcache.get(cache_key)
+  if result is not None:
+    cache.STATS["History", "hits"] += 1
+    return result
+  cache.STATS["History", "misses"] += 1
+  result = _QueryHistory(uid, *args)
+  memcache.set(cache_key, result, time=cache.HISTORY_TTL)
+  return result
+
+
+# pylint: disable=too-many-arguments
+def _QueryHistory(uid, offset, limit, cursor, cache_time, ascending, new,
+                  saved_only, blocked_only, sent_rose_only, received_rose_only,
+                  sent_message_only, received_message_only, visited_only,
+                  visited_by_only, light):
+  """Queries the datastore for History; see History for the arguments."""
   limit_args = (
       saved_only, blocked_only, sent_rose_only, received_rose_only,
       sent_message_only, received_message_only, visited_only, visited_by_only)
@@ -625,16 +2019,10 @@ def History(uid, offset=0, limit=10, cache_time=None, ascending=False,
   rel_cls = model.FullRelationship
   order = (lambda p: p) if ascending else (lambda p: -p)
   query = rel_cls.query(ancestor=UKey(uid))
-  if cache_time is not None:
-    query = query.filter(ndb.OR(
-        rel_cls.last_incoming > cache_time,
-        rel_cls.last_sent_rose > cache_time,
-        rel_cls.last_sent_message > cache_time))
 
   # Apply the filters
   if new:
-    query = query.filter(
-        ndb.OR(rel_cls.new_roses > 0, rel_cls.new_messages > 0))
+    query = query.filter(rel_cls.has_new == True)
   if saved_only:
     query = query.filter(rel_cls.saved == True)
   query = query.filter(rel_cls.blocked == blocked_only)
@@ -650,23 +2038,136 @@ def History(uid, offset=0, limit=10, cache_time=None, ascending=False,
   elif received_message_only:
     sort_prop = rel_cls.last_received_message
   elif visited_only:
-    rel_cls.last_visited
+    sort_prop = rel_cls.last_visited
   elif visited_by_only:
-    rel_cls.last_visited_by
+    sort_prop = rel_cls.last_visited_by
   else:
     sort_prop = rel_cls.last_incoming
-  query = query.filter(sort_prop > model.NEVER).order(order(sort_prop))
+  # Incremental syncs are a single range scan over last_updated, so the
+  # inequality can't be on the sort property too; those entries are instead
+  # dropped from the page after fetching it.
+  if cache_time is not None:
+    query = query.filter(rel_cls.last_updated > cache_time).order(
+        order(rel_cls.last_updated))
+  else:
+    query = query.filter(sort_prop > model.NEVER).order(order(sort_prop))
 
-  # Convert to dictionaries and add user names
-  full_rels = query.fetch(limit, offset=offset)
+  # Fetch the page
+  # pylint: disable=protected-access
+  projection = None
+  options = None
+  if light:
+    projection = [sort_prop, rel_cls.new_roses, rel_cls.new_messages]
+    if cache_time is not None:
+      projection.append(rel_cls.last_updated)
+    # Passed as options, because ndb checks a projection argument against the
+    # kind's root class, which lacks the FullRelationship properties.
+    options = ndb.QueryOptions(projection=[prop._name for prop in projection])
+  if offset:
+    logging.warning("History called with deprecated offset=%d", offset)
+  full_rels, next_cursor, more = query.fetch_page(
+      limit, offset=offset, options=options,
+      start_cursor=ndb.Cursor(urlsafe=cursor) if cursor else None)
+  next_cursor = next_cursor.urlsafe() if more and next_cursor else None
+  if cache_time is not None:
+    full_rels = [
+        rel for rel in full_rels
+        if _RelationshipValue(rel, sort_prop) > model.NEVER]
+
+  # In light mode, return just the projected properties
+  if light:
+    inbox = []
+    for rel in full_rels:
+      rel_dict = dict(
+          (prop._name, _RelationshipValue(rel, prop)) for prop in projection)
+      rel_dict["uid"] = rel.key.id()
+      inbox.append(rel_dict)
+    return inbox, next_cursor
+
+  # Relationships written before partner info was copied onto them need their
+  # partners looked up; that's done in a single batch, so the page costs a
+  # constant number of round trips.
+  FillPartnerInfo(*full_rels)
+
+  # Convert to dictionaries
   inbox = []
   for rel in full_rels:
-    uid = rel.key.id()
-    user = GetUser(uid)
     rel_dict = rel.to_dict()
     del rel_dict["class_"]
-    rel_dict["uid"] = uid
-    rel_dict["name"] = user.name
+    rel_dict["uid"] = rel.key.id()
+    rel_dict["name"] = rel.partner_name
     inbox.append(rel_dict)
 
-  return inbox
+  return inbox, next_cursor
+
+
+def _RelationshipValue(rel, prop):
+  """Reads a FullRelationship property, from a full or projected entity.
+
+  ndb builds the results of a projection query as the kind's root class, so
+  the FullRelationship properties are unknown to them, and their datetimes
+  come back as microseconds since epoch.
+
+  Args:
+    rel: (model.Relationship) The relationship.
+    prop: (ndb.Property) A FullRelationship property.
+
+  Returns:
+    The property's value.
+  """
+  # pylint: disable=protected-access
+  value = prop._get_value(rel)
+  if isinstance(prop, ndb.DateTimeProperty) and isinstance(value, (int, long)):
+    value = common.EPOCH + datetime.timedelta(microseconds=value)
+  return value
+
+
+# pylint: disable=no-value-for-parameter
+@ndb.transactional_tasklet(xg=True)
+def _MigrateRelationshipAsync(rel_key):
+  """Asynchronously re-puts a relationship; see MigrateRelationships.
+
+  Args:
+    rel_key: (ndb.Key) The relationship's key.
+
+  Returns:
+    (ndb.Future) Resolves once the relationship has been written.
+  """
+  rel = yield rel_key.get_async()
+  if not isinstance(rel, model.FullRelationship):
+    return
+  if rel.last_updated == model.NEVER:
+    rel.last_updated = max(
+        rel.last_incoming, rel.last_sent_rose, rel.last_sent_message,
+        rel.last_visited or model.NEVER, rel.last_visited_by or model.NEVER)
+  if rel.partner_name is None:
+    partner = yield GetUserAsync(rel_key.id())
+    rel.partner_name = partner.name
+    rel.partner_image_hash = partner.image_hash
+  yield rel.put_async()
+
+
+def MigrateRelationships(cursor=None, batch_size=100):
+  """Re-puts one batch of relationships, so that newer properties are indexed.
+
+  Relationships written before has_new and last_updated existed have no index
+  entries for them, so History's new and cache_time filters never find them.
+  Those written before partner info was copied onto them get it filled in, so
+  reading the inbox never touches the partners' Users.
+
+  Call repeatedly, passing in the returned cursor, until it returns None.
+
+  Args:
+    cursor: (ndb.Cursor) Where the previous batch left off.
+    batch_size: (int) The number of relationships to re-put.
+
+  Returns:
+    (ndb.Cursor or None) Where to resume, or None if there's nothing left.
+  """
+  keys, next_cursor, more = model.FullRelationship.query().fetch_page(
+      batch_size, start_cursor=cursor, keys_only=True)
+  for future in [_MigrateRelationshipAsync(key) for key in keys]:
+    future.get_result()
+  if keys:
+    cache.TouchInbox(*set(key.parent().id() for key in keys))
+  return next_cursor if more else None
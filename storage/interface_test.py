@@ -1,11 +1,16 @@
-# pylint: disable=missing-docstring
+# pylint: disable=missing-docstring,protected-access
 
 """Tests for the datastore interface."""
 
+import common
 import datetime
 import unittest
 
+from google.appengine.api import datastore
+from google.appengine.api import datastore_errors
+from google.appengine.api import memcache
 from google.appengine.ext import ndb
+from storage import cache
 from storage import interface
 from storage import model
 from test import testutils
@@ -86,6 +91,13 @@ class InterfaceAccountTest(unittest.TestCase):
     with self.assertRaises(LookupError):
       interface.LoadAccount(12345)
 
+  def testLoadAccountAsync(self):
+    ndb.get_context().clear_cache()
+    self.api.rpcs.clear()
+    user, match, search = interface.LoadAccountAsync(1).get_result()
+    self.assertTrue(self.api.rpcs["datastore_v3.Get"] <= 1)
+    self.assertEqual((user, match, search), interface.LoadAccount(1))
+
   def testCreateAccount(self):
     now = datetime.datetime(2015, 1, 1)
     user, match, search = interface.CreateAccount("Foo", 15, 20, now)
@@ -104,6 +116,27 @@ class InterfaceAccountTest(unittest.TestCase):
     self.assertEqual(match, match2)
     self.assertEqual(search, search2)
 
+  def testCreateAccounts(self):
+    profiles = [
+        {"name": "Bulk_{i}".format(i=i), "latitude": i, "longitude": -i,
+         "gender": 1, "radius": 10.0}
+        for i in range(3)]
+    self.api.rpcs.clear()
+    accounts = interface.CreateAccounts(profiles)
+    self.assertEqual(1, self.api.rpcs["datastore_v3.Put"])
+    uids = [user.key.id() for user, _, _ in accounts]
+    self.assertEqual(range(uids[0], uids[0] + 3), uids)
+    for i, uid in enumerate(uids):
+      user, match, search = interface.LoadAccount(uid)
+      self.assertEqual("Bulk_{i}".format(i=i), user.name)
+      self.assertEqual(
+          (i, -i, 1), (match.latitude, match.longitude, match.gender))
+      self.assertEqual(10.0, search.radius)
+      self.assertEqual(3, len(interface.GetGarden(uid)))
+    self.assertEqual([], interface.CreateAccounts([]))
+    with self.assertRaises(ValueError):
+      interface.CreateAccounts([{"latitude": 0, "longitude": 0, "foo": 1}])
+
   def testUpdateAccount(self):
     user, _, _ = interface.CreateAccount("Foo", 0, 0, datetime.datetime.today())
     uid = user.key.id()
@@ -130,6 +163,23 @@ class InterfaceAccountTest(unittest.TestCase):
     self.assertEqual(match2.gender, 2)
     self.assertEqual(search2.radius, 100)
 
+  def testUpdateAccountChanges(self):
+    self.api.rpcs.clear()
+    self.assertEqual(
+        (None, None, None),
+        interface.UpdateAccount(2, name="User_2", gender=1, radius=5))
+    self.assertEqual(1, self.api.rpcs["datastore_v3.Get"])
+    self.assertEqual(0, self.api.rpcs["datastore_v3.Put"])
+
+    self.api.rpcs.clear()
+    user, match, search = interface.UpdateAccount(
+        2, name="User_2", gender=2, radius=5)
+    self.assertEqual((None, 2, None), (user, match.gender, search))
+    self.assertEqual(1, self.api.rpcs["datastore_v3.Get"])
+    self.assertEqual(1, self.api.rpcs["datastore_v3.Put"])
+    self.assertEqual(
+        2, interface.GetForUid(model.MatchParameters, 2).gender)
+
   def testPing(self):
     start = datetime.datetime.today()
     match = interface.Ping(1, 100, 150)
@@ -144,6 +194,30 @@ class InterfaceAccountTest(unittest.TestCase):
     self.assertTrue(
         start <= match2.last_activity and match2.last_activity <= stop)
 
+  def testPingCoalescing(self):
+    interface.PING_STATS.clear()
+    now = datetime.datetime.today()
+    match = interface.Ping(2, 40, -74, now=now)
+    memcache.delete(cache._CacheKey(match.key))  # Let the write's lock lapse
+    interface.Ping(2, 40.001, -74, now=now + datetime.timedelta(minutes=1))
+    stored = model.MatchParameters.get_by_id(
+        1, parent=interface.UKey(2), use_cache=False, use_memcache=False)
+    self.assertEqual((40, now), (stored.latitude, stored.last_activity))
+    match = interface.GetForUid(model.MatchParameters, 2)
+    self.assertEqual(40.001, match.latitude)
+    self.assertEqual(now + datetime.timedelta(minutes=1), match.last_activity)
+
+    # Moving far enough, or going long enough since a write, writes again
+    interface.Ping(2, 41, -74, now=now + datetime.timedelta(minutes=2))
+    interface.Ping(2, 41, -74, now=now + datetime.timedelta(minutes=30))
+    stored = model.MatchParameters.get_by_id(
+        1, parent=interface.UKey(2), use_cache=False, use_memcache=False)
+    self.assertEqual(
+        now + datetime.timedelta(minutes=30), stored.last_activity)
+    self.assertEqual(
+        {"written": 3, "suppressed": 1, "suppression_rate": 0.25},
+        interface.PingStats())
+
   def testGetSetIntro(self):
     in_blob = testutils.Resource("intro.aac")
     interface.SetIntro(1, in_blob)
@@ -199,12 +273,13 @@ class InterfaceMessageTest(unittest.TestCase):
     self.assertEqual(1, recip_rel.new_messages)
     self.assertEqual(True, sent_msg.new)
     self.assertEqual(True, rcvd_msg.new)
-    self.assertEqual([], sent_msg.retrieved)
-    self.assertEqual([], rcvd_msg.retrieved)
+    self.assertEqual(0, sent_msg.retrieval_count)
+    self.assertEqual(None, rcvd_msg.first_retrieved)
 
     # Retrieve again, this time marking it as listened
     now2 = now + datetime.timedelta(days=1)
     interface.GetMessageFile(1, 2, now, True, now=now2)
+    self.api.RunTasks()
     recip_rel = interface.Relationship(2, 1)
     sent_msg = interface.GetForRelationship(
         model.SentMessage, 1, 2, now)
@@ -213,13 +288,15 @@ class InterfaceMessageTest(unittest.TestCase):
     self.assertEqual(0, recip_rel.new_messages)
     self.assertEqual(False, sent_msg.new)
     self.assertEqual(False, rcvd_msg.new)
-    self.assertEqual([now2], sent_msg.retrieved)
-    self.assertEqual([now2], rcvd_msg.retrieved)
+    for msg in (sent_msg, rcvd_msg):
+      self.assertEqual((now2, now2, 1), (
+          msg.first_retrieved, msg.last_retrieved, msg.retrieval_count))
 
     # Retrieve and mark as listened once more, ensure retrievals count up and
     # affect on number of new messages is idempotent
     now3 = now + datetime.timedelta(days=2)
     interface.GetMessageFile(1, 2, now, True, now=now3)
+    self.api.RunTasks()
     recip_rel = interface.Relationship(2, 1)
     sent_msg = interface.GetForRelationship(
         model.SentMessage, 1, 2, now)
@@ -228,8 +305,183 @@ class InterfaceMessageTest(unittest.TestCase):
     self.assertEqual(0, recip_rel.new_messages)
     self.assertEqual(False, sent_msg.new)
     self.assertEqual(False, rcvd_msg.new)
-    self.assertEqual([now2, now3], sent_msg.retrieved)
-    self.assertEqual([now2, now3], rcvd_msg.retrieved)
+    for msg in (sent_msg, rcvd_msg):
+      self.assertEqual((now2, now3, 2), (
+          msg.first_retrieved, msg.last_retrieved, msg.retrieval_count))
+
+    # Replaying a recorded retrieval changes nothing, even out of order
+    interface.RecordRetrieval(1, 2, now, now3)
+    interface.RecordRetrieval(1, 2, now, now2)
+    for msg in (
+        interface.GetForRelationship(model.SentMessage, 1, 2, now),
+        interface.GetForRelationship(model.ReceivedMessage, 2, 1, now)):
+      self.assertEqual((now2, now3, 2), (
+          msg.first_retrieved, msg.last_retrieved, msg.retrieval_count))
+
+  def testMigrateMessages(self):
+    now = datetime.datetime(2015, 1, 1)
+    times = [now + datetime.timedelta(days=i) for i in xrange(3)]
+    rel_key = model.Relationship(id=1, parent=interface.UKey(2)).key
+    for i in xrange(3):
+      legacy = datastore.Entity(
+          "SentMessage", id=common.Milis(times[i]), parent=rel_key.to_old_key())
+      legacy.update({"new": False, "retrieved": times[:i + 1]})
+      datastore.Put(legacy)
+
+    # Counted lazily when read
+    thread, _ = interface.Thread(2, 1, before_ms=common.Milis(times[-1]) + 1)
+    self.assertEqual([3, 2, 1], [msg["retrieval_count"] for msg in thread])
+
+    # Migrated in bulk
+    cursor = interface.MigrateMessages(model.SentMessage, batch_size=2)
+    while cursor:
+      cursor = interface.MigrateMessages(
+          model.SentMessage, cursor=cursor, batch_size=2)
+    msg = interface.GetForRelationship(model.SentMessage, 2, 1, times[-1])
+    self.assertEqual(
+        (times[0], times[-1], 3),
+        (msg.first_retrieved, msg.last_retrieved, msg.retrieval_count))
+    self.assertNotIn("retrieved", msg.to_dict())
+
+  def testIdempotentSendMessage(self):
+    audio = testutils.Resource("intro.aac")
+    sender = interface.CreateAccount("Foo", 0, 0)[0].key.id()
+    recipient = interface.CreateAccount("Bar", 0, 0)[0].key.id()
+    now = datetime.datetime(2015, 2, 1)
+    later = now + datetime.timedelta(seconds=5)
+    sent = interface.SendMessage(
+        sender, recipient, audio, now=now, idempotency_key="abc")
+    self.assertEqual(now, sent)
+
+    # Retries return the original send time without writing anything
+    self.api.rpcs.clear()
+    self.assertEqual(now, interface.SendMessage(
+        sender, recipient, audio, now=later, idempotency_key="abc"))
+    memcache.flush_all()
+    self.assertEqual(now, interface.SendMessage(
+        sender, recipient, audio, now=later, idempotency_key="abc"))
+    self.assertEqual(0, self.api.rpcs["datastore_v3.Put"])
+    self.assertRaises(
+        LookupError, interface.GetForRelationship, model.MessageFile, sender,
+        recipient, later)
+
+    # Keys are scoped to the sender and the kind of send
+    self.assertEqual(later, interface.SendMessage(
+        recipient, sender, audio, now=later, idempotency_key="abc"))
+
+  def testIdempotencyExpires(self):
+    audio = testutils.Resource("intro.aac")
+    sender = interface.CreateAccount("Foo", 0, 0)[0].key.id()
+    recipient = interface.CreateAccount("Bar", 0, 0)[0].key.id()
+    now = datetime.datetime(2015, 3, 1)
+    later = now + datetime.timedelta(seconds=5)
+    key = interface.IdempotencyMarkerKey(sender, "message", "abc")
+    expired = datetime.datetime.today() - datetime.timedelta(
+        seconds=interface.IDEMPOTENCY_TTL + 1)
+
+    # Expired markers are ignored, and deleted when looked up
+    model.IdempotencyMarker(key=key, sent=now, created=expired).put()
+    self.assertEqual(
+        None, interface.LookupIdempotentSend(sender, "message", "abc"))
+    self.assertEqual(None, key.get())
+
+    # Or replaced by a new send with the same key
+    model.IdempotencyMarker(key=key, sent=now, created=expired).put()
+    self.assertEqual(later, interface.SendMessage(
+        sender, recipient, audio, now=later, idempotency_key="abc"))
+    self.assertEqual(later, key.get().sent)
+    memcache.flush_all()
+    self.assertEqual(
+        later, interface.LookupIdempotentSend(sender, "message", "abc"))
+
+  def testSendMessageFiles(self):
+    audio = testutils.Resource("intro.aac")
+    now = datetime.datetime.today() + datetime.timedelta(30)
+    interface.TRANSACTION_STATS.clear()
+    interface.SendMessage(1, 2, audio, now=now)
+    stats = interface.TransactionStats()["SendMessage"]
+    self.assertEqual(
+        (1, 1, 0), (stats["attempts"], stats["commits"], stats["failures"]))
+    self.assertEqual(0.0, stats["retry_rate"])
+    self.assertFalse(interface.CollectMessageFile(1, 2, common.Milis(now)))
+    self.assertEqual(audio, interface.GetMessageFile(1, 2, now, False))
+
+    # Refused messages don't leave their audio behind
+    can_message = interface.CanMessage
+    interface.CanMessage = lambda sender_rel, recipient_rel: False
+    try:
+      refused = now + datetime.timedelta(1)
+      self.assertEqual(None, interface.SendMessage(1, 2, audio, now=refused))
+    finally:
+      interface.CanMessage = can_message
+    self.assertRaises(
+        LookupError, interface.GetForRelationship, model.MessageFile, 1, 2,
+        refused)
+
+    # Nor do sends that fail, once they're checked on
+    def Fail(*_):
+      raise datastore_errors.TransactionFailedError()
+    send_message_transaction = interface._SendMessageTransaction
+    interface._SendMessageTransaction = Fail
+    try:
+      failed = now + datetime.timedelta(2)
+      self.assertRaises(
+          datastore_errors.TransactionFailedError,
+          interface.SendMessage, 1, 2, audio, now=failed)
+    finally:
+      interface._SendMessageTransaction = send_message_transaction
+    self.assertEqual(audio, interface.GetMessageFile(1, 2, failed, False))
+    self.api.RunTasks()
+    self.assertRaises(
+        LookupError, interface.GetForRelationship, model.MessageFile, 1, 2,
+        failed)
+
+  def testUnreadTotals(self):
+    audio = testutils.Resource("intro.aac")
+    now = datetime.datetime.today() + datetime.timedelta(10)
+    interface.SendMessage(2, 1, audio, now=now)
+    interface.SendMessage(2, 1, audio, now=now + datetime.timedelta(1))
+    interface.SendRose(2, 1, 1, now=now)
+    interface.GetMessageFile(2, 1, now, True)
+    interface.GetMessageFile(2, 1, now, True)
+    self.api.RunTasks()
+    totals = interface.GetUnreadTotals(1)
+    self.assertEqual((1, 1), (totals.new_roses, totals.new_messages))
+
+    # Served from memcache once cached
+    memcache.flush_all()
+    interface.GetUnreadTotals(1)
+    ndb.get_context().clear_cache()
+    self.api.rpcs.clear()
+    interface.GetUnreadTotals(1)
+    self.assertEqual(0, self.api.rpcs["datastore_v3.Get"])
+
+    # Accounts without totals have them summed from their relationships
+    totals.key.delete()
+    cache.Invalidate(totals.key)
+    totals = interface.GetUnreadTotals(1)
+    self.assertEqual((1, 1), (totals.new_roses, totals.new_messages))
+
+    # Including relationships written before has_new was indexed
+    user, _, _ = interface.CreateAccount("Foo", 0, 0)
+    legacy = datastore.Entity(
+        "Relationship", id=1, parent=user.key.to_old_key())
+    legacy.update({
+        "class": ["Relationship", "FullRelationship"], "new_roses": 1,
+        "new_messages": 2})
+    datastore.Put(legacy)
+    totals_key = ndb.Key(model.UnreadTotals, 1, parent=user.key)
+    totals_key.delete()
+    cache.Invalidate(totals_key)
+    totals = interface.GetUnreadTotals(user.key.id())
+    self.assertEqual((1, 2), (totals.new_roses, totals.new_messages))
+
+    # The sum is saved, so later reads don't query the relationships again
+    ndb.get_context().clear_cache()
+    self.api.rpcs.clear()
+    totals = interface.GetUnreadTotals(user.key.id())
+    self.assertEqual((1, 2), (totals.new_roses, totals.new_messages))
+    self.assertEqual(0, self.api.rpcs["datastore_v3.RunQuery"])
 
 
 class InterfaceGardenTest(unittest.TestCase):
@@ -267,6 +519,36 @@ class InterfaceGardenTest(unittest.TestCase):
     with self.assertRaises(LookupError):
       interface.GetGarden(12345)
 
+  def testMigrateGarden(self):
+    now = datetime.datetime(2015, 1, 1)
+    garden_keys = []
+    for _ in xrange(2):
+      user, _, _ = interface.CreateAccount("Foo", 0, 0)
+      garden_key = interface.GardenKey(user.key.id())
+      garden_key.delete()
+      for i in (1, 2, 3):
+        model.Rose(id=i, parent=garden_key, bloomed=now, planted=now).put()
+      garden_keys.append(garden_key)
+    lazy_key, bulk_key = garden_keys
+
+    # Migrated lazily on first access
+    garden = interface.GetGarden(lazy_key.parent().id())
+    self.assertEqual([1, 2, 3], [rose.key.id() for rose in garden])
+    self.assertEqual([now] * 3, [rose.bloomed for rose in garden])
+    self.assertEqual(3, len(lazy_key.get().roses))
+    self.assertEqual([], model.Rose.query(ancestor=lazy_key).fetch())
+
+    # Migrated in bulk. The ancestor query applies the legacy writes, so the
+    # mapper's global query sees them under the test consistency policy.
+    self.assertEqual(3, len(model.Rose.query(ancestor=bulk_key).fetch()))
+    cursor = interface.MigrateGardens(batch_size=2)
+    while cursor:
+      cursor = interface.MigrateGardens(cursor=cursor, batch_size=2)
+    garden = bulk_key.get()
+    self.assertEqual(3, len(garden.roses))
+    self.assertEqual([now] * 3, [rose.bloomed for rose in garden.roses])
+    self.assertEqual([], model.Rose.query(ancestor=bulk_key).fetch())
+
   def testSendRose(self):
     now = interface.SendRose(1, 2, 1)
     sender_rel, recip_rel = interface.Relationships(1, 2, full=True)
@@ -280,6 +562,16 @@ class InterfaceGardenTest(unittest.TestCase):
     send_again = interface.SendRose(1, 2, 1)
     self.assertEqual(None, send_again)
 
+  def testIdempotentSendRose(self):
+    user, _, _ = interface.CreateAccount("Foo", 0, 0)
+    uid = user.key.id()
+    now = interface.SendRose(uid, 1, 1, idempotency_key="abc")
+    garden = interface.LoadGarden(uid)
+    self.assertEqual(now, interface.SendRose(uid, 1, 2, idempotency_key="abc"))
+    self.assertEqual(garden, interface.LoadGarden(uid))
+    self.assertEqual(
+        None, interface.SendRose(uid, 1, 1, idempotency_key="def"))
+
   def testWater(self):
     user, _, _ = interface.CreateAccount("Foo", 0, 0)
     uid = user.key.id()
@@ -316,6 +608,172 @@ class InterfaceGardenTest(unittest.TestCase):
     pass
 
 
+class InterfaceThreadTest(unittest.TestCase):
+
+  @classmethod
+  def setUpClass(cls):
+    cls.api = testutils.TestApi()
+    testutils.FakeUsers(3)
+
+  @classmethod
+  def tearDownClass(cls):
+    cls.api.Stop()
+
+  def testThread(self):
+    audio = testutils.Resource("intro.aac")
+    now = datetime.datetime.today()
+    times = [now + datetime.timedelta(seconds=i) for i in range(5)]
+    for i, when in enumerate(times):
+      if i % 2:
+        interface.SendMessage(2, 1, audio, now=when)
+      else:
+        interface.SendMessage(1, 2, audio, now=when)
+    interface.SendMessage(1, 3, audio, now=now)
+    interface.GetMessageFile(2, 1, times[3], True)
+    self.api.RunTasks()
+
+    self.api.rpcs.clear()
+    thread, before_ms = interface.Thread(1, 2, limit=3)
+    self.assertEqual(0, self.api.rpcs["datastore_v3.Get"])
+    self.assertEqual(
+        [common.Milis(when) for when in reversed(times[2:])],
+        [msg["send_timestamp_ms"] for msg in thread])
+    self.assertEqual([True, False, True], [msg["sent"] for msg in thread])
+    self.assertEqual([True, False, True], [msg["new"] for msg in thread])
+    self.assertEqual([0, 1, 0], [msg["retrieval_count"] for msg in thread])
+    self.assertEqual(common.Milis(times[2]), before_ms)
+
+    thread, before_ms = interface.Thread(1, 2, before_ms=before_ms, limit=3)
+    self.assertEqual(
+        [common.Milis(times[1]), common.Milis(times[0])],
+        [msg["send_timestamp_ms"] for msg in thread])
+    self.assertEqual(None, before_ms)
+
+    # The same conversation, from the other side
+    thread, _ = interface.Thread(2, 1)
+    self.assertEqual(
+        [False, True, False, True, False], [msg["sent"] for msg in thread])
+
+  def testThreadSameTimestamp(self):
+    audio = testutils.Resource("intro.aac")
+    uid = interface.CreateAccount("Foo", 0, 0)[0].key.id()
+    now = datetime.datetime.today()
+    interface.SendMessage(1, uid, audio, now=now - datetime.timedelta(1))
+    interface.SendMessage(1, uid, audio, now=now)
+    interface.SendMessage(uid, 1, audio, now=now)
+
+    # Messages sharing a timestamp stay on the same page
+    thread, before_ms = interface.Thread(uid, 1, limit=1)
+    self.assertEqual(
+        [(common.Milis(now), True), (common.Milis(now), False)],
+        sorted(
+            [(msg["send_timestamp_ms"], msg["sent"]) for msg in thread],
+            reverse=True))
+    thread, before_ms = interface.Thread(
+        uid, 1, before_ms=before_ms, limit=1)
+    self.assertEqual(
+        [common.Milis(now - datetime.timedelta(1))],
+        [msg["send_timestamp_ms"] for msg in thread])
+    self.assertEqual(None, before_ms)
+
+    # Oversized pages are clamped
+    interface.THREAD_MAX_PAGE_SIZE, max_page_size = (
+        2, interface.THREAD_MAX_PAGE_SIZE)
+    try:
+      thread, before_ms = interface.Thread(uid, 1, limit=10 ** 9)
+    finally:
+      interface.THREAD_MAX_PAGE_SIZE = max_page_size
+    self.assertEqual(2, len(thread))
+    self.assertEqual(common.Milis(now), before_ms)
+
+
+class InterfaceVisitsTest(unittest.TestCase):
+
+  @classmethod
+  def setUpClass(cls):
+    cls.api = testutils.TestApi()
+    testutils.FakeUsers(4)
+
+  @classmethod
+  def tearDownClass(cls):
+    cls.api.Stop()
+
+  def testRecordVisit(self):
+    now = datetime.datetime.today()
+    interface.RecordVisit(2, 1, now=now)
+    interface.RecordVisit(3, 1, now=now + datetime.timedelta(1))
+    interface.RecordVisit(2, 1, now=now + datetime.timedelta(2))
+    self.assertEqual(
+        [(2, now + datetime.timedelta(2)), (3, now + datetime.timedelta(1))],
+        [(visit["uid"], visit["timestamp"])
+         for visit in interface.GetRecentVisitors(1)])
+    self.assertEqual(
+        now + datetime.timedelta(2), interface.Relationship(2, 1).last_visited)
+    self.assertEqual(
+        now + datetime.timedelta(2),
+        interface.Relationship(1, 2).last_visited_by)
+    self.assertEqual([], interface.GetRecentVisitors(3))
+
+  def testQueueVisit(self):
+    user, _, _ = interface.CreateAccount("Popular", 0, 0)
+    uid = user.key.id()
+    # Queued visits keep millisecond precision
+    now = datetime.datetime.today().replace(microsecond=0)
+    interface.QueueVisit(1, uid, now=now)
+    interface.QueueVisit(1, uid, now=now + datetime.timedelta(seconds=1))
+    interface.QueueVisit(2, uid, now=now)
+    interface.QueueVisit(uid, 2, now=now)
+
+    # Nothing is written until the queue is flushed
+    self.assertEqual(None, interface.Relationship(1, uid).last_visited)
+    self.assertEqual([], interface.GetRecentVisitors(uid))
+    self.api.RunTasks()
+    self.assertEqual(
+        now + datetime.timedelta(seconds=1),
+        interface.Relationship(1, uid).last_visited)
+    self.assertEqual(
+        now + datetime.timedelta(seconds=1),
+        interface.Relationship(uid, 1).last_visited_by)
+    self.assertEqual(now, interface.Relationship(uid, 2).last_visited)
+    self.assertEqual(
+        [1, 2], [visit["uid"] for visit in interface.GetRecentVisitors(uid)])
+    self.assertEqual(
+        [], self.api.taskqueue.get_filtered_tasks(
+            queue_names=[interface.VISITS_QUEUE]))
+    self.assertEqual(0, interface.FlushVisits())
+
+    # Replaying an older visit changes nothing
+    interface.RecordVisit(1, uid, now=now)
+    self.assertEqual(
+        now + datetime.timedelta(seconds=1),
+        interface.GetRecentVisitors(uid)[0]["timestamp"])
+
+  def testRecentVisitorsCapped(self):
+    cap = interface.RECENT_VISITORS_CAP
+    interface.RECENT_VISITORS_CAP = 2
+    try:
+      now = datetime.datetime.today()
+      for visitor in (1, 2, 3):
+        interface.RecordVisit(
+            visitor, 4, now=now + datetime.timedelta(visitor))
+    finally:
+      interface.RECENT_VISITORS_CAP = cap
+    self.assertEqual(
+        [3, 2], [visit["uid"] for visit in interface.GetRecentVisitors(4)])
+
+  def testVisitThenMessage(self):
+    audio = testutils.Resource("intro.aac")
+    now = datetime.datetime.today() + datetime.timedelta(100)
+    interface.RecordVisit(3, 2, now=now)
+    interface.SendMessage(3, 2, audio, now=now + datetime.timedelta(1))
+    rel = interface.Relationship(3, 2)
+    self.assertTrue(isinstance(rel, model.FullRelationship))
+    self.assertEqual(now, rel.last_visited)
+    self.assertEqual(now + datetime.timedelta(1), rel.last_sent_message)
+    inbox, _ = interface.History(2, visited_by_only=True)
+    self.assertEqual([3], [entry["uid"] for entry in inbox])
+
+
 class InterfaceHistoryTest(unittest.TestCase):
 
   @classmethod
@@ -338,6 +796,190 @@ class InterfaceHistoryTest(unittest.TestCase):
     #TODO assertions
     #TODO saved, blocked, visited
 
+  def testHistoryRecent(self):
+    audio = testutils.Resource("intro.aac")
+    now = datetime.datetime.today() + datetime.timedelta(500)
+    times = [now + datetime.timedelta(seconds=i) for i in range(6)]
+    for when in times:
+      interface.SendMessage(4, 2, audio, now=when)
+    rose_time = interface.SendRose(
+        4, 2, 3, now=now + datetime.timedelta(seconds=10))
+    interface.GetMessageFile(4, 2, times[-1], True)
+    self.api.RunTasks()
+    inbox, _ = interface.History(2)
+    entry = [rel for rel in inbox if rel["uid"] == 4][0]
+    self.assertEqual(
+        [("rose", common.Milis(rose_time), True)] +
+        [("message", common.Milis(when), when != times[-1])
+         for when in reversed(times[-4:])],
+        [(event["kind"], event["timestamp_ms"], event["new"])
+         for event in entry["recent"]])
+    self.assertFalse(any(event["sent"] for event in entry["recent"]))
+    sent_recent = interface.Relationship(4, 2).recent
+    self.assertTrue(all(event.sent for event in sent_recent))
+    self.assertEqual(False, sent_recent[1].new)
+
+  def testHistoryPartnerInfo(self):
+    audio = testutils.Resource("intro.aac")
+    now = datetime.datetime.today() + datetime.timedelta(400)
+    interface.SendMessage(5, 3, audio, now=now)
+    inbox, _ = interface.History(3)
+    self.assertEqual("User_5", inbox[0]["name"])
+    self.assertEqual("User_5", inbox[0]["partner_name"])
+
+    # Renames and new images fan out to partners' relationships
+    interface.UpdateAccount(5, name="Renamed")
+    interface.SetImage(5, testutils.Resource("icon.png"))
+    self.assertTrue(self.api.RunTasks() >= 2)
+    rel = interface.Relationship(3, 5)
+    self.assertEqual("Renamed", rel.partner_name)
+    self.assertEqual(interface.GetUser(5).image_hash, rel.partner_image_hash)
+    self.api.rpcs.clear()
+    inbox, _ = interface.History(3)
+    self.assertEqual("Renamed", inbox[0]["name"])
+    self.assertEqual(0, self.api.rpcs["datastore_v3.Get"])
+
+  def testHistoryLight(self):
+    full, _ = interface.History(1, received_message_only=True)
+    light, _ = interface.History(1, received_message_only=True, light=True)
+    self.assertEqual(
+        [(rel["uid"], rel["last_received_message"], rel["new_messages"])
+         for rel in full],
+        [(rel["uid"], rel["last_received_message"], rel["new_messages"])
+         for rel in light])
+    self.assertTrue(all(
+        set(rel.keys()) == set(
+            ["uid", "last_received_message", "new_roses", "new_messages"])
+        for rel in light))
+    updated, _ = interface.History(1, cache_time=model.NEVER, light=True)
+    self.assertEqual(
+        [rel["uid"] for rel in interface.History(1, cache_time=model.NEVER)[0]],
+        [rel["uid"] for rel in updated])
+    self.assertTrue(all(
+        isinstance(rel["last_updated"], datetime.datetime) for rel in updated))
+
+  def testHistoryNew(self):
+    audio = testutils.Resource("intro.aac")
+    now = datetime.datetime.today() + datetime.timedelta(200)
+    interface.SendMessage(3, 2, audio, now=now)
+    unread, _ = interface.History(2, new=True)
+    self.assertEqual(3, unread[0]["uid"])
+    self.assertTrue(all(rel["has_new"] for rel in unread))
+    interface.GetMessageFile(3, 2, now, True)
+    self.api.RunTasks()
+    unread, _ = interface.History(2, new=True)
+    self.assertFalse(3 in [rel["uid"] for rel in unread])
+
+  def testHistoryPagination(self):
+    audio = testutils.Resource("intro.aac")
+    now = datetime.datetime.today()
+    for partner in (2, 3, 4):
+      interface.SendMessage(
+          1, partner, audio, now=now + datetime.timedelta(20 + partner))
+    everything, cursor = interface.History(1, sent_message_only=True, limit=50)
+    self.assertEqual(None, cursor)
+    paged = []
+    while True:
+      page, cursor = interface.History(
+          1, sent_message_only=True, limit=2, cursor=cursor)
+      paged += page
+      if not cursor:
+        break
+    self.assertEqual(
+        [rel["uid"] for rel in everything], [rel["uid"] for rel in paged])
+    by_offset, _ = interface.History(1, sent_message_only=True, offset=1)
+    self.assertEqual(everything[1:], by_offset)
+
+  def testHistoryCached(self):
+    audio = testutils.Resource("intro.aac")
+    now = datetime.datetime.today() + datetime.timedelta(300)
+    before, _ = interface.History(4)
+    self.api.rpcs.clear()
+    self.assertEqual(before, interface.History(4)[0])
+    self.assertEqual(0, self.api.rpcs["datastore_v3.RunQuery"])
+    interface.SendMessage(5, 4, audio, now=now)
+    after, _ = interface.History(4)
+    self.assertEqual(5, after[0]["uid"])
+    self.assertEqual(now, after[0]["last_incoming"])
+
+  def testHistoryCacheTime(self):
+    audio = testutils.Resource("intro.aac")
+    now = datetime.datetime.today() + datetime.timedelta(100)
+    user, _, _ = interface.CreateAccount("Foo", 0, 0)
+    uid = user.key.id()
+    interface.SendMessage(2, uid, audio, now=now)
+    interface.SendRose(uid, 3, 2, now=now + datetime.timedelta(1))
+    updated, _ = interface.History(uid, cache_time=now - datetime.timedelta(1))
+    self.assertEqual([2], [rel["uid"] for rel in updated])
+    updated, _ = interface.History(
+        uid, cache_time=now - datetime.timedelta(1), sent_rose_only=True)
+    self.assertEqual([3], [rel["uid"] for rel in updated])
+    updated, _ = interface.History(
+        uid, cache_time=now + datetime.timedelta(2))
+    self.assertEqual([], updated)
+    interface.GetMessageFile(
+        2, uid, now, True, now=now + datetime.timedelta(3))
+    self.api.RunTasks()
+    updated, _ = interface.History(
+        uid, cache_time=now + datetime.timedelta(2))
+    self.assertEqual([2], [rel["uid"] for rel in updated])
+
+  def testHistoryBatchesUserLookups(self):
+    audio = testutils.Resource("intro.aac")
+    now = datetime.datetime.today()
+    for partner in (2, 3, 4, 5):
+      interface.SendMessage(
+          partner, 1, audio, now=now + datetime.timedelta(10 + partner))
+    ndb.get_context().clear_cache()
+    self.api.rpcs.clear()
+    inbox, _ = interface.History(1, limit=50)
+    self.assertTrue(len(inbox) >= 4)
+    self.assertTrue(self.api.rpcs["datastore_v3.Get"] <= 1)
+
+  def testMigrateRelationships(self):
+    user, _, _ = interface.CreateAccount("Foo", 0, 0)
+    uid = user.key.id()
+    now = datetime.datetime(2015, 1, 1)
+    legacy = datastore.Entity(
+        "Relationship", id=1, parent=interface.UKey(uid).to_old_key())
+    legacy.update({
+        "class": ["Relationship", "FullRelationship"], "blocked": False,
+        "new_messages": 1, "last_received_message": now, "last_incoming": now})
+    datastore.Put(legacy)
+    self.assertEqual([], interface.History(uid, new=True)[0])
+    self.assertEqual([], interface.History(uid, cache_time=model.NEVER)[0])
+
+    cursor = interface.MigrateRelationships(batch_size=2)
+    while cursor:
+      cursor = interface.MigrateRelationships(cursor=cursor, batch_size=2)
+    self.assertEqual(
+        [1], [rel["uid"] for rel in interface.History(uid, new=True)[0]])
+    updated, _ = interface.History(uid, cache_time=model.NEVER)
+    self.assertEqual([now], [rel["last_updated"] for rel in updated])
+
+    # Partner info was filled in, so the inbox no longer reads Users
+    ndb.get_context().clear_cache()
+    self.api.rpcs.clear()
+    inbox, _ = interface.History(uid)
+    self.assertEqual(["User_1"], [rel["name"] for rel in inbox])
+    self.assertEqual(0, self.api.rpcs["datastore_v3.Get"])
+
+  def testPartnerInfoSyncs(self):
+    user, _, _ = interface.CreateAccount("Foo", 0, 0)
+    uid = user.key.id()
+    interface.SendMessage(
+        uid, 4, testutils.Resource("intro.aac"),
+        now=datetime.datetime(2015, 1, 1))
+    cache_time = datetime.datetime.today()
+    updated, _ = interface.History(4, cache_time=cache_time, limit=50)
+    self.assertNotIn(uid, [rel["uid"] for rel in updated])
+
+    # Renames count as updates for incremental syncs
+    interface.UpdateAccount(uid, name="Renamed")
+    self.api.RunTasks()
+    updated, _ = interface.History(4, cache_time=cache_time, limit=50)
+    self.assertIn(uid, [rel["uid"] for rel in updated])
+
 
 if __name__ == "__main__":
   unittest.main()
@@ -33,6 +33,9 @@ class User(ndb.Model):
   gender_string = ndb.StringProperty()  # If MatchParameters.gender == 2
   sexuality_string = ndb.StringProperty()  # If MatchParameters.sexuality == 3
   joined = ndb.DateTimeProperty()
+  # Content hashes of the IntroFile and ImageFile, used as their versions.
+  intro_hash = ndb.StringProperty(indexed=False)
+  image_hash = ndb.StringProperty(indexed=False)
 
 
 class IntroFile(ndb.Model):
@@ -84,20 +87,47 @@ class SearchSettings(ndb.Model):
   accept_other_sexualities = ndb.IntegerProperty(repeated=True)
 
 
+class IdempotencyMarker(ndb.Model):
+  """Records that a send made with a client-supplied idempotency key committed.
+
+  Written in the same transaction as the send, so a retried request can return
+  the original outcome instead of sending again.
+
+  Ancestor: (User) The sender
+  Name: (str) "{action}:{idempotency key}", where action is "message" or "rose"
+  """
+  sent = ndb.DateTimeProperty(required=True, indexed=False)
+  # When the marker was written; markers expire after interface.IDEMPOTENCY_TTL.
+  created = ndb.DateTimeProperty(indexed=False)
+
+
 # --------------------------------------------------------------------------- #
 # The garden contains roses that a user can send to a prospective match, and  #
 # can "water" to make the roses grow faster.                                  #
 # --------------------------------------------------------------------------- #
 
+class Rose(ndb.Model):
+  """Defines a rose growing in the garden.
+
+  Each user's three growing roses are packed into their Garden, so the garden
+  is read and written as a single entity. Older accounts stored them as
+  stand-alone entities (Ancestor: (User, Garden); Name: 1, 2, or 3), which are
+  packed into the Garden on first access.
+
+  Rose has subclasses used in storingrelationships taht differ only in the
+  structure of their ancestor path and name.
+  """
+  bloomed = ndb.DateTimeProperty(required=True)  # In the future when unbloomed
+  planted = ndb.DateTimeProperty(required=True)
+
+
 class Garden(ndb.Model):
   """Defines a user's garden.
 
-  Doesn't actually hold any info yet; might contain metadata in the future.
-
   Ancestor: (User) The user
   Name: 1
   """
-  pass
+  roses = ndb.LocalStructuredProperty(Rose, repeated=True)  # Always 3 roses
 
 
 class Watering(ndb.Expando):
@@ -114,19 +144,6 @@ class Watering(ndb.Expando):
   bloomed_rose = ndb.IntegerProperty()
 
 
-class Rose(ndb.Model):
-  """Defines a rose growing in the garden.
-
-  Rose has subclasses used in storingrelationships taht differ only in the
-  structure of their ancestor path and name.
-
-  Ancestor: (User, Garden) The user's garden
-  Name: 1, 1, or 2 (each user has 3 roses)
-  """
-  bloomed = ndb.DateTimeProperty(required=True)  # In the future when unbloomed
-  planted = ndb.DateTimeProperty(required=True)
-
-
 # --------------------------------------------------------------------------- #
 # Relationships contain all interactions between pairs of users. Data will    #
 # always be duplicated across two relationships, for the sender and the       #
@@ -148,17 +165,96 @@ class Relationship(polymodel.PolyModel):
   last_visited_by = ndb.DateTimeProperty()
 
 
+class RecentEvent(ndb.Model):
+  """A message or rose in the recent summary of a FullRelationship."""
+  kind = ndb.StringProperty()  # "message" or "rose"
+  sent = ndb.BooleanProperty()  # True if the agent sent it
+  timestamp_ms = ndb.IntegerProperty()  # The id of the message or rose
+  new = ndb.BooleanProperty()  # Cleared when a message is listened to
+
+
 class FullRelationship(Relationship):
   """A relationship where users have exchange communications."""
   blocked = ndb.BooleanProperty(default=False)
   saved = ndb.BooleanProperty(default=False)
   new_roses = ndb.IntegerProperty(default=0)
   new_messages = ndb.IntegerProperty(default=0)
+  # Stored with every put, so "unread only" is a single equality filter.
+  has_new = ndb.ComputedProperty(
+      lambda self: bool(self.new_roses or self.new_messages))
   last_sent_rose = ndb.DateTimeProperty(default=NEVER)
   last_received_rose = ndb.DateTimeProperty(default=NEVER)
   last_sent_message = ndb.DateTimeProperty(default=NEVER)
   last_received_message = ndb.DateTimeProperty(default=NEVER)
   last_incoming = ndb.DateTimeProperty(default=NEVER)
+  # Last time anything about the relationship changed, for incremental sync.
+  last_updated = ndb.DateTimeProperty(default=NEVER)
+  # Copied from the patient's User, so reading the inbox never touches Users.
+  partner_name = ndb.StringProperty(indexed=False)
+  partner_image_hash = ndb.StringProperty(indexed=False)
+  # The last few messages and roses either way, most recent first, so the
+  # inbox can show previews without querying each conversation.
+  recent = ndb.LocalStructuredProperty(RecentEvent, repeated=True)
+
+
+class Visit(ndb.Model):
+  """A profile view, as recorded in RecentVisitors."""
+  uid = ndb.IntegerProperty()  # The visitor
+  timestamp = ndb.DateTimeProperty()
+
+
+class RecentVisitors(ndb.Model):
+  """The most recent visitors to a user's profile, most recent first.
+
+  Capped at a fixed number of visitors, each listed once, so loading a user's
+  visitors is a single get no matter how many relationships they have.
+
+  Ancestor: (User) The visited user
+  Name: 1
+  """
+  visits = ndb.LocalStructuredProperty(Visit, repeated=True)
+
+
+class UnreadTotals(ndb.Model):
+  """The sums of new_roses and new_messages over a user's relationships.
+
+  Kept up to date in the same transactions as the relationships' counters, so
+  the unread badge doesn't need to page through the inbox.
+
+  Ancestor: (User) The user
+  Name: 1
+  """
+  new_roses = ndb.IntegerProperty(default=0, indexed=False)
+  new_messages = ndb.IntegerProperty(default=0, indexed=False)
+
+
+class InboundLog(ndb.Model):
+  """A shard of a user's log of inbound messages and roses.
+
+  Never stored; it only roots its own entity group, so that senders append to
+  a recipient's log without contending on the recipient's entity group.
+
+  Ancestor: None
+  Name: (str) "{recipient}:{shard}"
+  """
+  pass
+
+
+class InboundEvent(ndb.Model):
+  """A message or rose not yet folded into the recipient's relationship.
+
+  Written by the sender's transaction, then applied to the recipient's
+  relationship, UnreadTotals and received traces by a later fold.
+
+  Ancestor: (InboundLog) A shard of the recipient's log
+  Name: (str) "{kind}:{sender}:{send timestamp in miliseconds since epoch}"
+  """
+  recipient = ndb.IntegerProperty(required=True, indexed=False)
+  sender = ndb.IntegerProperty(required=True, indexed=False)
+  kind = ndb.StringProperty(required=True, indexed=False)  # "message" or "rose"
+  sent = ndb.DateTimeProperty(required=True, indexed=False)
+  bloomed = ndb.DateTimeProperty(indexed=False)  # Roses only
+  planted = ndb.DateTimeProperty(indexed=False)  # Roses only
 
 
 class SentRose(Rose):
@@ -185,10 +281,16 @@ class Message(ndb.Model):
   Message has two subclasses that differ only in the structure of their
   ancestor path and name.
 
+  Older messages stored every retrieval time in a repeated "retrieved"
+  property, which is folded into the fields below on their next retrieval or
+  by interface.MigrateMessages.
+
   Name: (int) Send timestamp, in miliseconds since epoch
   """
   new = ndb.BooleanProperty(required=True, default=True)
-  retrieved = ndb.DateTimeProperty(repeated=True)
+  first_retrieved = ndb.DateTimeProperty(indexed=False)
+  last_retrieved = ndb.DateTimeProperty(indexed=False)
+  retrieval_count = ndb.IntegerProperty(default=0, indexed=False)
 
 
 class SentMessage(Message):
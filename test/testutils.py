@@ -1,13 +1,16 @@
 """Utilities for testing the app."""
 
 import api
+import collections
 import datetime
 import json
 import logging
 import os
 import webtest
 
+from google.appengine.api import apiproxy_stub_map
 from google.appengine.datastore import datastore_stub_util
+from google.appengine.ext import deferred
 from google.appengine.ext import ndb
 from google.appengine.ext import testbed
 from storage import interface
@@ -52,13 +55,44 @@ class TestApi(object):
       probability=0)
     self.testbed.init_datastore_v3_stub(consistency_policy=self.policy)
     self.testbed.init_memcache_stub()
+    self.testbed.init_taskqueue_stub(
+      root_path=os.path.join(os.path.dirname(__file__), ".."))
+    self.taskqueue = self.testbed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
     ndb.get_context().clear_cache()
     self.test_app = webtest.TestApp(api.API)
 
+    # Count RPCs by "service.Method", so tests can pin down round trips.
+    self.rpcs = collections.Counter()
+    apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(
+        "rpc_counter", self._CountRpc)
+
+  # pylint: disable=unused-argument
+  def _CountRpc(self, service, call, request, response):
+    self.rpcs["{s}.{c}".format(s=service, c=call)] += 1
+
   def Stop(self):
     self.testbed.deactivate()
     del(self.test_app.app)
 
+  def RunTasks(self, queue_name="default"):
+    """Runs deferred tasks until the queue is empty.
+
+    Args:
+      queue_name: (str) The push queue to drain.
+
+    Returns:
+      (int) The number of tasks run.
+    """
+    count = 0
+    while True:
+      tasks = self.taskqueue.get_filtered_tasks(queue_names=[queue_name])
+      if not tasks:
+        return count
+      self.taskqueue.FlushQueue(queue_name)
+      for task in tasks:
+        deferred.run(task.payload)
+        count += 1
+
   def Call(self, endpoint, post=False, expect_err=False, env=None, **kwargs):
     """Mocks a call to the server.
 
@@ -109,34 +143,33 @@ SEX_MATH = {
 
 
 def FakeUsers(cap=None):
-  uid = 0
   now = datetime.datetime.today()
+  profiles = []
   for age_offset in (0, -10, -5, 5, 10):
     for long_offset in (0, -5, 5):
       for lat_offset in (0, -5, 5):
         for sexuality in (0, 1, 2, 3):
           for gender in (0, 1, 2):
-            uid += 1
-            if cap and uid > cap:
+            if cap and len(profiles) >= cap:
               break
-            name = "User_{uid}".format(uid=uid)
-            latitude = DEFAULT_LATITUDE + lat_offset
-            longitude = DEFAULT_LONGITUDE + long_offset
+            uid = len(profiles) + 1
             age = DEFAULT_AGE + age_offset
             ams, afs, aos = SEX_MATH[(gender, sexuality)]
-
-            # Create the user
-            interface.CreateAccount(name, latitude, longitude)
-            interface.UpdateAccount(
-              uid,
-              gender_string="genderqueer" if gender == 2 else None,
-              sexuality_string="queer" if sexuality == 3 else None,
-              gender=gender,
-              sexuality=sexuality,
-              birthday=now - datetime.timedelta(days=age * 365),
-              radius=DEFAULT_RADIUS,
-              min_age=int((age / 2) + 7),
-              max_age=int(2 * (age - 7)),
-              accept_male_sexualities=ams,
-              accept_female_sexualities=afs,
-              accept_other_sexualities=aos)
+            profiles.append({
+                "name": "User_{uid}".format(uid=uid),
+                "latitude": DEFAULT_LATITUDE + lat_offset,
+                "longitude": DEFAULT_LONGITUDE + long_offset,
+                "gender_string": "genderqueer" if gender == 2 else None,
+                "sexuality_string": "queer" if sexuality == 3 else None,
+                "gender": gender,
+                "sexuality": sexuality,
+                "birthday": now - datetime.timedelta(days=age * 365),
+                "radius": DEFAULT_RADIUS,
+                "min_age": int((age / 2) + 7),
+                "max_age": int(2 * (age - 7)),
+                "accept_male_sexualities": ams,
+                "accept_female_sexualities": afs,
+                "accept_other_sexualities": aos})
+
+  # Create the users, with uids 1 through len(profiles) in a fresh datastore
+  interface.CreateAccounts(profiles, now=now)